@@ -0,0 +1,183 @@
+# facemark_batch.py
+"""Mark attendance for many recorded lectures without the GUI.
+
+    python facemark_batch.py lectures/ --workers 4 --sample-fps 5
+    python facemark_batch.py manifest.csv --workers 2
+    python facemark_batch.py --live 0 --section A --duration 600
+
+A directory is scanned for videos: files directly inside it use --section
+(every student when omitted), files in a sub-folder use the folder name as
+their section. A manifest is a CSV with video and section columns; relative
+video paths are resolved against the manifest's directory. Every video
+writes its usual CSV to attendance_logs.
+
+--live marks attendance from a camera index or stream URL instead, until
+--duration seconds pass or Ctrl+C is pressed; the CSV is written either way.
+"""
+
+import argparse
+import csv
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from facemark_core import (ensure_dirs, get_gallery, get_matcher, warm_up_embedder, mark_attendance_from_video,
+                           mark_attendance_live, GALLERY_DIR, EMBEDDINGS_FILE, LIVE_SAMPLE_FPS, SEARCH_MODES)
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+BATCH_WORKERS = 2
+
+def videos_from_tree(root, section=None):
+    """Return (video, section) jobs for the videos in `root` and its section folders."""
+    jobs = []
+    for entry in sorted(os.listdir(root)):
+        path = os.path.join(root, entry)
+        if os.path.isdir(path):
+            jobs.extend((os.path.join(path, f), entry) for f in sorted(os.listdir(path))
+                        if f.lower().endswith(VIDEO_EXTENSIONS))
+        elif entry.lower().endswith(VIDEO_EXTENSIONS):
+            jobs.append((path, section))
+    return jobs
+
+def read_manifest(csv_path):
+    """Read (video, section) jobs from a manifest CSV with video and section columns."""
+    base = os.path.dirname(os.path.abspath(csv_path))
+    jobs = []
+    with open(csv_path, newline='') as f:
+        for row in csv.DictReader(f):
+            row = {key.strip().lower(): (value or '').strip() for key, value in row.items() if key}
+            if not row.get('video'):
+                continue
+            jobs.append((os.path.join(base, row['video']), row.get('section') or None))
+    return jobs
+
+def process_video(video_path, section, options, cancel_event):
+    """Process one video and return a result dict for the summary."""
+    start = time.perf_counter()
+    result = {'video': video_path, 'section': section, 'marked': 0, 'frames_analysed': 0, 'faces_detected': 0,
+              'video_seconds': 0.0, 'csv_path': None, 'error': None}
+    try:
+        success, marked, stats = mark_attendance_from_video(video_path, section, cancel_event=cancel_event,
+                                                            return_stats=True, **options)
+    except Exception as e:
+        result['error'] = str(e)
+        return result
+    finally:
+        result['elapsed'] = time.perf_counter() - start
+    if stats is None:
+        result['error'] = "video not found"
+        return result
+    result['marked'] = len(marked or [])
+    result['frames_analysed'] = stats['frames_analysed']
+    result['faces_detected'] = stats.get('faces_detected', 0)
+    if stats.get('fps') and stats.get('frames_total'):
+        result['video_seconds'] = stats['frames_total'] / stats['fps']
+    result['csv_path'] = stats.get('csv_path')
+    if stats.get('stop_reason') == 'cancelled':
+        result['error'] = "cancelled"
+    return result
+
+def run_batch(jobs, workers=BATCH_WORKERS, cancel_event=None, **options):
+    """Process `jobs` of (video, section) on `workers` threads sharing one model.
+
+    `options` are passed to mark_attendance_from_video. Returns the per-video
+    results and the wall-clock time.
+    """
+    cancel_event = cancel_event or threading.Event()
+    # Load FaceNet and build each section's matcher once, before the workers share them
+    warm_up_embedder(background=False)
+    gallery = get_gallery(GALLERY_DIR, EMBEDDINGS_FILE)
+    for section in {section for _, section in jobs}:
+        get_matcher(section, options.get('search', 'exact'), gallery.pin, options.get('fallback', False))
+
+    start = time.perf_counter()
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="facemark-batch") as pool:
+        futures = [pool.submit(process_video, video, section, options, cancel_event) for video, section in jobs]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                name = os.path.basename(result['video'])
+                if result['error']:
+                    print(f"[!] {name}: {result['error']}")
+                else:
+                    print(f"[✓] {name}: {result['marked']} marked in {result['elapsed']:.1f}s "
+                          f"({len(results)}/{len(jobs)})")
+        except KeyboardInterrupt:
+            print("[!] Interrupted, cancelling remaining videos")
+            cancel_event.set()
+            for future in futures:
+                future.cancel()
+            raise
+    return results, time.perf_counter() - start
+
+def print_summary(results, wall_time):
+    """Print per-batch throughput: videos/hour, frames/sec and faces/sec."""
+    done = [r for r in results if not r['error']]
+    frames = sum(r['frames_analysed'] for r in done)
+    faces = sum(r['faces_detected'] for r in done)
+    video_seconds = sum(r['video_seconds'] for r in done)
+    wall_time = max(wall_time, 1e-9)
+    print(f"[i] Processed {len(done)}/{len(results)} videos in {wall_time:.1f}s")
+    print(f"[i] Throughput: {len(done) / wall_time * 3600:.1f} videos/hour, "
+          f"{frames / wall_time:.1f} frames/sec, {faces / wall_time:.1f} faces/sec")
+    if video_seconds:
+        print(f"[i] {video_seconds / 60:.1f} min of video at {video_seconds / wall_time:.1f}x real time")
+
+def run_live(source, section=None, duration=None, sample_fps=None, show_preview=False, **options):
+    """Run a live session until `duration` passes or Ctrl+C; return True if anyone was marked."""
+    # Accept "0" for the first camera as well as stream URLs and file paths
+    source = int(source) if str(source).isdigit() else source
+    # Ctrl+C ends the session inside mark_attendance_live, which still writes the CSV
+    success, _ = mark_attendance_live(source, section, duration, sample_fps=sample_fps or LIVE_SAMPLE_FPS,
+                                      show_preview=show_preview, **options)
+    return success
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mark attendance for a batch of lecture recordings.")
+    parser.add_argument('source', nargs='?', help="folder of videos (sub-folders per section) or a manifest CSV")
+    parser.add_argument('--live', metavar='SOURCE', help="mark attendance from a camera index or stream URL instead")
+    parser.add_argument('--duration', type=float, help="seconds a --live session runs (until Ctrl+C when omitted)")
+    parser.add_argument('--preview', action='store_true', help="show the --live camera preview")
+    parser.add_argument('--section', help="section for videos directly inside the folder or for --live")
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help="videos processed in parallel")
+    parser.add_argument('--sample-fps', type=float, help="frames analysed per second of video")
+    parser.add_argument('--track-faces', action='store_true', help="reuse embeddings of tracked faces")
+    parser.add_argument('--stop-when-complete', action='store_true', help="stop once every student is marked")
+    parser.add_argument('--search', choices=SEARCH_MODES, default='exact')
+    parser.add_argument('--fallback', action='store_true', help="also match students from other sections")
+    args = parser.parse_args(argv)
+
+    if args.live is not None:
+        ensure_dirs()
+        return 0 if run_live(args.live, args.section, args.duration, args.sample_fps, args.preview,
+                             search=args.search, fallback=args.fallback) else 1
+    if args.source is None:
+        parser.error("a source folder or manifest is required unless --live is given")
+    if os.path.isdir(args.source):
+        jobs = videos_from_tree(args.source, args.section)
+    elif os.path.isfile(args.source):
+        jobs = read_manifest(args.source)
+    else:
+        print(f"[!] {args.source} not found")
+        return 1
+    if not jobs:
+        print("[!] No videos to process")
+        return 1
+
+    ensure_dirs()
+    print(f"[i] {len(jobs)} video(s), {args.workers} worker(s)")
+    options = dict(sample_fps=args.sample_fps, track_faces=args.track_faces,
+                   stop_when_complete=args.stop_when_complete, search=args.search, fallback=args.fallback)
+    try:
+        results, wall_time = run_batch(jobs, args.workers, **options)
+    except KeyboardInterrupt:
+        return 130
+    print_summary(results, wall_time)
+    return 0 if all(not r['error'] for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
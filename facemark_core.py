@@ -1,196 +1,1741 @@
 # facemark_core.py
 
+import csv
+import multiprocessing
 import os
 import cv2
-import pickle
+import queue
+import threading
+import time
 import numpy as np
+from collections import ChainMap, Counter, deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
-from keras_facenet import FaceNet
-from sklearn.metrics.pairwise import cosine_similarity
+from facemark_gallery import (GALLERY_DIR, build_gallery, l2_normalize, get_gallery, read_gallery,
+                              write_gallery, rewrite_gallery, gallery_exists, quantize, fit_pca, project, write_projection,
+                              make_prototypes, MAX_PROTOTYPES, append_journal, maybe_compact)
+from facemark_index import IVF_MIN_SIZE, IVFIndex, measure_recall, top_k
 
-EMBEDDINGS_FILE = "embeddings.pkl"
+EMBEDDINGS_FILE = "embeddings.pkl"  # legacy pickle, migrated into GALLERY_DIR on first load
 IMAGES_DIR = "student_images"
 ATTENDANCE_DIR = "attendance_logs"
 HAAR_CASCADE_FILEPATH = os.path.join(os.path.dirname(cv2.__file__), 'data', 'haarcascade_frontalface_default.xml')
+MATCH_THRESHOLD = 0.5
+EMBEDDING_DIM = 512
+FACE_SIZE = (160, 160)
+EMBED_BATCH_SIZE = 32
+EMBED_MAX_WAIT = 2.0  # seconds a queued crop may wait for its batch to fill
+CHANGE_THUMB_SIZE = (64, 36)
+TRACK_IOU = 0.3
+TRACK_MAX_MISSED = 5  # analysed frames a track survives without a matching box
+TRACK_MAX_EMBEDS = 3
+TRACK_CONFIDENT_SCORE = 0.7
+TRACK_RETRY_FRAMES = 15  # analysed frames before an unidentified track is embedded again
+PIPELINE_QUEUE_SIZE = 8  # frames buffered between pipeline stages
+RERANK_CANDIDATES = 5  # quantized-scan candidates re-scored in float32
+QUANTIZED_BLOCK_ROWS = 4096  # gallery rows dequantized at a time
+SEARCH_MODES = ('exact', 'ivf')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+ENROLL_BATCH_SIZE = 64
+ENROLL_WORKERS = min(8, os.cpu_count() or 1)
+REGISTER_SAMPLES = 10
+REGISTER_WINDOW = 3.0  # seconds over which webcam samples are spread
+REGISTER_TIMEOUT = 30.0
+REGISTER_EMBED_BATCH = 5
+LIVE_SAMPLE_FPS = 5  # frames per second analysed in live mode
 
-embedder = FaceNet()
+# FaceNet pulls in TensorFlow, so it is only loaded on first use (or by warm_up_embedder)
+_embedder = None
+_embedder_lock = threading.Lock()
+
+def get_embedder():
+    """Return the shared FaceNet model, loading it on first use."""
+    global _embedder
+    if _embedder is None:
+        with _embedder_lock:
+            if _embedder is None:
+                from keras_facenet import FaceNet
+                _embedder = FaceNet()
+    return _embedder
+
+def warm_up_embedder(background=True):
+    """Load FaceNet and run one dummy inference so the first real batch skips graph tracing.
+
+    With `background` the work runs in a daemon thread, which is returned.
+    """
+    def warm_up():
+        try:
+            start = time.perf_counter()
+            get_embedder().embeddings(np.zeros((1,) + FACE_SIZE + (3,), dtype=np.uint8))
+            print(f"[i] FaceNet ready in {time.perf_counter() - start:.1f}s")
+        except Exception as e:
+            print(f"[!] FaceNet warm-up failed: {e}")
+
+    if not background:
+        warm_up()
+        return None
+    thread = threading.Thread(target=warm_up, name="facenet-warmup", daemon=True)
+    thread.start()
+    return thread
+
+# Result of matching one face: best student, its score and the runner-up
+Match = namedtuple('Match', ['name', 'score', 'runner_up', 'runner_up_score'])
+
+class GalleryMatcher:
+    """Holds the normalized prototype embeddings of a set of students as one float32 matrix.
+
+    Student i owns rows `offsets[i]:offsets[i + 1]`. Cosine similarity of
+    every query face against every prototype is a single matrix product,
+    and a student's score is the maximum over its prototypes, taken with one
+    segmented reduction.
+    """
+
+    def __init__(self, data):
+        self.names = list(data.keys())
+        self.info = {name: data[name] for name in self.names}
+        blocks = [np.asarray(data[name]['embedding'], dtype=np.float32).reshape(-1, EMBEDDING_DIM) for name in self.names]
+        if blocks:
+            matrix = np.concatenate(blocks)
+        else:
+            matrix = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        self.matrix = np.ascontiguousarray(l2_normalize(matrix))
+        self.set_offsets(np.concatenate([[0], np.cumsum([len(block) for block in blocks], dtype=np.int64)]))
+        self.index = None  # optional IVFIndex used instead of the exhaustive scan
+        self.quantized = None  # optional float16/int8 copy of `matrix` scanned before a float32 re-rank
+        self.scales = None
+        self.projection = None  # optional PCA applied to query embeddings; `matrix` is already projected
+
+    @classmethod
+    def from_gallery(cls, gallery, section=None, projection=None):
+        """Build a matcher over one section's block of a Gallery without re-normalizing it.
+
+        With a (mean, components) `projection` both the gallery rows and
+        later queries are matched in the reduced PCA space.
+        """
+        start, end = gallery.section_range(section)
+        row_start, row_end = gallery.row_range(section)
+        matcher = cls({})
+        matcher.names = [s['name'] for s in gallery.students[start:end]]
+        matcher.info = {s['name']: {'roll_no': s['roll_no'], 'section': s['section']}
+                        for s in gallery.students[start:end]}
+        matcher.set_offsets(gallery.offsets[start:end + 1] - row_start)
+        if projection is not None:
+            matcher.projection = projection
+            matcher.matrix = np.ascontiguousarray(project(gallery.matrix[row_start:row_end], projection))
+        else:
+            matcher.matrix = np.ascontiguousarray(gallery.matrix[row_start:row_end], dtype=np.float32)
+        if gallery.quantized is not None and projection is None:
+            matcher.quantized = gallery.quantized[row_start:row_end]
+            matcher.scales = gallery.scales[row_start:row_end] if gallery.scales is not None else None
+        return matcher
+
+    def set_offsets(self, offsets):
+        """Set the per-student prototype row boundaries (len(names) + 1 entries)."""
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        counts = np.diff(self.offsets)
+        self.max_prototypes = int(counts.max()) if len(counts) else 1
+        self.multi_prototype = self.max_prototypes > 1
+        # (students, max_prototypes) row table, short students padded with their first row
+        slots = np.minimum(np.arange(self.max_prototypes), np.maximum(counts[:, None] - 1, 0))
+        self.prototype_rows = self.offsets[:-1, None] + slots
+        # IVF entries are individual prototypes
+        self.keys = [(name, j) for name, count in zip(self.names, counts) for j in range(count)]
+
+    def __len__(self):
+        return len(self.names)
+
+    def reduce(self, row_scores):
+        """Collapse (faces, prototypes) scores to (faces, students) by taking each student's maximum."""
+        if not self.multi_prototype or not len(self.names):
+            return row_scores
+        return np.maximum.reduceat(row_scores, self.offsets[:-1], axis=1)
+
+    def prepare(self, embeddings):
+        """Normalize query embeddings and bring them into the matcher's space."""
+        if self.projection is not None:
+            return project(np.atleast_2d(embeddings), self.projection)
+        return l2_normalize(np.atleast_2d(embeddings))
+
+    def scores(self, embeddings):
+        """Return the (faces, students) cosine similarity matrix."""
+        return self.reduce(self.prepare(embeddings) @ self.matrix.T)
+
+    def quantized_scores(self, queries):
+        """Approximate scores from the quantized matrix, dequantized block by block."""
+        scores = np.empty((len(queries), len(self.matrix)), dtype=np.float32)
+        for start in range(0, len(self.matrix), QUANTIZED_BLOCK_ROWS):
+            block = np.asarray(self.quantized[start:start + QUANTIZED_BLOCK_ROWS], dtype=np.float32)
+            if self.scales is not None:
+                block *= self.scales[start:start + QUANTIZED_BLOCK_ROWS, None]
+            scores[:, start:start + len(block)] = queries @ block.T
+        return self.reduce(scores)
+
+    def _rerank(self, queries):
+        # Shortlist students on the quantized matrix, then score their prototypes exactly
+        cand, _ = top_k(self.quantized_scores(queries), RERANK_CANDIDATES)
+        valid = cand >= 0
+        rows = self.matrix[self.prototype_rows[np.where(valid, cand, 0)]]
+        exact = np.einsum('fd,fkpd->fkp', queries, rows).max(axis=2)
+        exact[~valid] = -np.inf
+        order, scores = top_k(exact, 2)
+        idx = np.where(order >= 0, np.take_along_axis(cand, np.maximum(order, 0), axis=1), -1)
+        # Padded candidates of small sections also come back as -1
+        scores[idx < 0] = 0.0
+        return idx, scores
+
+    def match(self, embeddings):
+        """Return one Match per row of `embeddings`."""
+        embeddings = np.atleast_2d(embeddings)
+        if not self.names:
+            return [Match(None, 0.0, None, 0.0) for _ in range(len(embeddings))]
+        if self.index is not None:
+            names, scores = self._search_index(self.prepare(embeddings))
+        else:
+            if self.quantized is not None:
+                idx, scores = self._rerank(self.prepare(embeddings))
+            else:
+                idx, scores = top_k(self.scores(embeddings), 2)
+            lookup = np.array(self.names + [None], dtype=object)
+            names = lookup[idx]  # -1 (no runner-up) picks the trailing None
+        return [
+            Match(names[row, 0], float(scores[row, 0]), names[row, 1], float(scores[row, 1]))
+            for row in range(len(names))
+        ]
+
+    def _search_index(self, queries):
+        # Enough prototype hits that the best two distinct students are among them
+        keys, key_scores = self.index.search(queries, self.max_prototypes + 1)
+        names = np.full((len(queries), 2), None, dtype=object)
+        scores = np.zeros((len(queries), 2), dtype=np.float32)
+        for row in range(len(queries)):
+            found = 0
+            for key, score in zip(keys[row], key_scores[row]):
+                if key is None or found == 2:
+                    break
+                if found and names[row, 0] == key[0]:
+                    continue
+                names[row, found], scores[row, found] = key[0], score
+                found += 1
+        return names, scores
+
+class HierarchicalMatcher:
+    """Matches against one section first and falls back to a larger gallery.
+
+    Faces whose best section score is not above `threshold` are matched
+    again against `fallback` (usually the whole gallery) and the better hit
+    is kept, so a student sitting in on another section is still recognised
+    while most lookups only scan the section's small matrix. `names` and
+    len() describe the section roster; `info` covers both matchers.
+    """
+
+    def __init__(self, primary, fallback, threshold=MATCH_THRESHOLD):
+        self.primary = primary
+        self.fallback = fallback
+        self.threshold = threshold
+        self.names = primary.names
+        self.info = ChainMap(primary.info, fallback.info)
+        self.lookups = 0
+        self.fallback_lookups = 0
+
+    def __len__(self):
+        return len(self.primary)
+
+    def match(self, embeddings):
+        """Return one Match per row of `embeddings`."""
+        embeddings = np.atleast_2d(embeddings)
+        matches = self.primary.match(embeddings)
+        self.lookups += len(matches)
+        retry = [i for i, match in enumerate(matches) if match.score <= self.threshold]
+        if retry:
+            self.fallback_lookups += len(retry)
+            for i, match in zip(retry, self.fallback.match(embeddings[retry])):
+                if match.score > matches[i].score:
+                    matches[i] = match
+        return matches
+
+class EmbeddingBatcher:
+    """Collects face crops, possibly from several frames, and embeds them in batches.
+
+    FaceNet has a large fixed cost per call, so crops are queued until
+    `batch_size` of them are pending or the oldest has waited `max_wait`
+    seconds. Call `poll()` regularly, since a partial batch is otherwise
+    only checked when the next crop arrives, and `flush()` at the end of the
+    input to embed the remainder.
+    """
+
+    def __init__(self, batch_size=EMBED_BATCH_SIZE, max_wait=EMBED_MAX_WAIT):
+        self.batch_size = max(1, int(batch_size))
+        self.max_wait = max_wait
+        self.faces = []
+        self.tags = []
+        self.oldest = None
+        self.calls = 0
+        self.embedded = 0
+
+    def __len__(self):
+        return len(self.faces)
+
+    def add(self, face, tag=None):
+        """Queue one 160x160 crop; return the (tags, embeddings) of any batch this completed."""
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        self.faces.append(face)
+        self.tags.append(tag)
+        if len(self.faces) >= self.batch_size:
+            return self.flush()
+        return self.poll()
+
+    def poll(self):
+        """Embed the pending crops if the oldest has waited `max_wait`; return (tags, embeddings)."""
+        if self.oldest is not None and self.max_wait is not None and time.monotonic() - self.oldest >= self.max_wait:
+            return self.flush()
+        return [], None
+
+    def flush(self):
+        """Embed every pending crop and return (tags, embeddings)."""
+        if not self.faces:
+            return [], None
+        faces, tags = self.faces, self.tags
+        self.faces, self.tags, self.oldest = [], [], None
+        embeddings = np.asarray(get_embedder().embeddings(np.stack(faces)), dtype=np.float32)
+        self.calls += 1
+        self.embedded += len(faces)
+        return tags, embeddings
+
+def embed_faces(faces, batch_size=EMBED_BATCH_SIZE):
+    """Embed a list of 160x160 crops with one FaceNet call per `batch_size` crops."""
+    if len(faces) == 0:
+        return np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    batches = []
+    for start in range(0, len(faces), batch_size):
+        batches.append(np.asarray(get_embedder().embeddings(np.stack(faces[start:start + batch_size])), dtype=np.float32))
+    return np.concatenate(batches)
+
+# Latest IVF index per section, kept across gallery reloads so that registering
+# or deleting a student only updates the affected entries. Each gallery version
+# syncs its own copy, so matchers already handed out never see another version.
+_ann_indexes = {}
+
+def get_matcher(section=None, search='exact', pin=None, fallback=False):
+    """Return the GalleryMatcher for `section`, cached until the gallery changes.
+
+    `search` is 'exact' for an exhaustive scan or 'ivf' for the approximate
+    IVFIndex, which is only used once the searched block has IVF_MIN_SIZE
+    students. A PCA projection stored with the gallery (see set_gallery_pca)
+    is applied automatically. `pin` matches against that gallery snapshot
+    (see Gallery.pin) instead of the latest one. With `fallback` and a
+    section, a HierarchicalMatcher retries unrecognised faces against the
+    whole gallery.
+    """
+    if search not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode {search!r}, expected one of {SEARCH_MODES}")
+    gallery = get_gallery(GALLERY_DIR, EMBEDDINGS_FILE, pin)
+    if fallback and section is not None:
+        return gallery.cached(('matcher', section, search, 'fallback'),
+                              lambda: HierarchicalMatcher(get_matcher(section, search, pin),
+                                                          get_matcher(None, search, pin)))
+
+    def build():
+        matcher = GalleryMatcher.from_gallery(gallery, section, gallery.projection)
+        if search == 'ivf' and len(matcher) >= IVF_MIN_SIZE:
+            key = (section, matcher.matrix.shape[1])
+            index = _ann_indexes[key].copy() if key in _ann_indexes else IVFIndex()
+            index.sync(matcher.keys, matcher.matrix)
+            if pin is None:
+                _ann_indexes[key] = index
+            matcher.index = index
+        return matcher
+    return gallery.cached(('matcher', section, search), build)
+
+def refresh_ann_indexes():
+    """Apply gallery changes to every IVF index in use."""
+    for section in {section for section, _ in _ann_indexes}:
+        get_matcher(section, 'ivf')
+
+def set_gallery_quantization(quantization):
+    """Rewrite the gallery with a 'float32', 'float16' or 'int8' matching copy."""
+    rewrite_gallery(GALLERY_DIR, quantization, EMBEDDINGS_FILE)
+    refresh_ann_indexes()
+
+def compare_quantized_matching(section=None, queries=None, quantization='int8', noise=0.3, sample=500):
+    """Report how often a quantized gallery changes match decisions.
+
+    Compares best student and threshold decision of the full-precision
+    matcher with a float16/int8 one over `queries` (by default perturbed
+    gallery embeddings). Returns the fraction of identical decisions.
+    """
+    exact = GalleryMatcher.from_gallery(get_gallery(GALLERY_DIR, EMBEDDINGS_FILE), section)
+    if not len(exact):
+        print("[!] No registered students to compare")
+        return None
+    # A gallery stored as int8 loads with its own quantized copy; the baseline must not use it
+    exact.quantized = exact.scales = None
+    approx = GalleryMatcher.from_gallery(get_gallery(GALLERY_DIR, EMBEDDINGS_FILE), section)
+    approx.quantized, approx.scales = quantize(exact.matrix, quantization)
+    if queries is None:
+        rng = np.random.default_rng(0)
+        rows = exact.matrix[rng.choice(len(exact.matrix), min(sample, len(exact.matrix)), replace=False)]
+        queries = rows + rng.normal(scale=noise / np.sqrt(rows.shape[1]), size=rows.shape)
+    same = 0
+    for a, b in zip(exact.match(queries), approx.match(queries)):
+        decision_a = a.name if a.score > MATCH_THRESHOLD else None
+        decision_b = b.name if b.score > MATCH_THRESHOLD else None
+        same += decision_a == decision_b
+    # The re-rank rescores in float32, so measure the quantized scan itself
+    delta = approx.quantized_scores(approx.prepare(queries)) - exact.scores(queries)
+    max_delta = float(np.abs(delta).max())
+    memory = approx.quantized.nbytes + (approx.scales.nbytes if approx.scales is not None else 0)
+    print(f"[i] {quantization}: {same}/{len(queries)} identical decisions, max score change {max_delta:.2e}, "
+          f"{memory / 1024:.0f} KiB vs {exact.matrix.nbytes / 1024:.0f} KiB float32")
+    return same / len(queries)
+
+def check_ann_recall(section=None, queries=None, noise=0.3, sample=500):
+    """Compare IVF top-1 results with exact search and return the recall.
+
+    Without `queries`, up to `sample` gallery embeddings perturbed by
+    Gaussian noise of relative size `noise` stand in for live faces.
+    """
+    gallery = get_gallery(GALLERY_DIR, EMBEDDINGS_FILE)
+    matcher = GalleryMatcher.from_gallery(gallery, section)
+    if not len(matcher):
+        print("[!] No registered students to check")
+        return None
+    index = IVFIndex()
+    index.build(matcher.keys, matcher.matrix)
+    if queries is None:
+        rng = np.random.default_rng(0)
+        rows = matcher.matrix[rng.choice(len(matcher.matrix), min(sample, len(matcher.matrix)), replace=False)]
+        queries = rows + rng.normal(scale=noise / np.sqrt(rows.shape[1]), size=rows.shape)
+    recall = measure_recall(index, matcher.keys, matcher.matrix, l2_normalize(queries))
+    print(f"[i] IVF recall@1 vs exact search: {recall * 100:.2f}% over {len(queries)} queries")
+    return recall
 
 def ensure_dirs():
     os.makedirs(IMAGES_DIR, exist_ok=True)
     os.makedirs(ATTENDANCE_DIR, exist_ok=True)
 
-def load_embeddings():
-    if os.path.exists(EMBEDDINGS_FILE):
-        with open(EMBEDDINGS_FILE, 'rb') as f:
-            return pickle.load(f)
-    return {}
+def load_embeddings(mmap=True):
+    """Return the gallery as a {name: {'embedding', 'roll_no', 'section'}} dict."""
+    if not mmap and gallery_exists():
+        return read_gallery(GALLERY_DIR, mmap=False).to_dict()
+    return get_gallery(GALLERY_DIR, EMBEDDINGS_FILE).to_dict()
 
 def save_embeddings(embeddings):
-    with open(EMBEDDINGS_FILE, 'wb') as f:
-        pickle.dump(embeddings, f)
+    write_gallery(build_gallery(embeddings), GALLERY_DIR)
+
+class CaptureWorker:
+    """Saves and embeds registration crops on a background thread.
+
+    The camera loop only hands crops over with `put`, so the preview keeps
+    running at camera rate while images are written and FaceNet runs in
+    small batches. `finish()` waits for the backlog and returns the
+    embeddings; `stop()` ends the thread without embedding what is left.
+    """
+
+    def __init__(self, student_dir, batch_size=REGISTER_EMBED_BATCH):
+        self.student_dir = student_dir
+        self.queue = queue.Queue()
+        self.batcher = EmbeddingBatcher(batch_size, max_wait=None)
+        self.embeddings = []
+        self.error = None
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run, name="registration-capture", daemon=True)
+        self.thread.start()
+
+    def put(self, index, face):
+        self.queue.put((index, face))
+
+    def _keep(self, result):
+        _, embeddings = result
+        if embeddings is not None:
+            self.embeddings.append(embeddings)
+
+    def _run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                if self.stopped:
+                    continue
+                index, face = item
+                cv2.imwrite(os.path.join(self.student_dir, f"{index}.jpg"), face)
+                self._keep(self.batcher.add(face, index))
+            if not self.stopped:
+                self._keep(self.batcher.flush())
+        except Exception as e:
+            self.error = e
+
+    def finish(self):
+        """Wait for every queued crop and return their embeddings."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        if not self.embeddings:
+            return np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+        return np.concatenate(self.embeddings)
 
-def register_student(name, roll_no, section):
+    def stop(self):
+        """Drop the queued crops and end the thread."""
+        self.stopped = True
+        self.queue.put(None)
+
+def register_student(name, roll_no, section, folder_path=None, samples=REGISTER_SAMPLES,
+                     window=REGISTER_WINDOW, source=0):
+    """Register a student from webcam captures, or from the images in `folder_path`.
+
+    The camera preview runs at full rate; a face is only detected and kept
+    once every `window` / `samples` seconds, so the `samples` crops are
+    spread over the window instead of coming from consecutive frames.
+    Saving and embedding them happens in a CaptureWorker.
+    """
+    if folder_path:
+        return bulk_register([{'name': name, 'roll_no': roll_no, 'section': section, 'folder': folder_path}])
     print(f"[i] Registering {name}, Roll: {roll_no}, Section: {section}")
     student_dir = os.path.join(IMAGES_DIR, name)
     os.makedirs(student_dir, exist_ok=True)
 
-    cap = cv2.VideoCapture(0)
+    cap = cv2.VideoCapture(source)
     if not cap.isOpened():
         print("[!] Camera error")
         return
 
     face_cascade = cv2.CascadeClassifier(HAAR_CASCADE_FILEPATH)
+    worker = CaptureWorker(student_dir)
+    interval = window / max(samples, 1)
     count = 0
-    embeddings = []
+    next_sample = time.monotonic()
+    deadline = next_sample + REGISTER_TIMEOUT
 
-    while count < 10:
-        ret, frame = cap.read()
-        if not ret:
-            break
+    try:
+        while count < samples and time.monotonic() < deadline:
+            ret, frame = cap.read()
+            if not ret:
+                break
 
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+            now = time.monotonic()
+            if now >= next_sample:
+                gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+                if len(faces):
+                    x, y, w, h = max(faces, key=lambda box: box[2] * box[3])
+                    count += 1
+                    worker.put(count, cv2.resize(frame[y:y + h, x:x + w], FACE_SIZE))
+                    # Without a face, keep trying on the next frames
+                    next_sample = now + interval
 
-        for (x, y, w, h) in faces:
-            face = frame[y:y + h, x:x + w]
-            face = cv2.resize(face, (160, 160))
-            emb = embedder.embeddings([face])[0]
-            embeddings.append(emb)
-            count += 1
-            cv2.imwrite(f"{student_dir}/{count}.jpg", face)
-            break
+            cv2.putText(frame, f"{count}/{samples}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+            cv2.imshow("Capture", frame)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+    except BaseException:
+        # Otherwise the worker thread waits for more crops forever
+        worker.stop()
+        raise
+    finally:
+        cap.release()
+        cv2.destroyAllWindows()
 
-        cv2.imshow("Capture", frame)
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-
-    cap.release()
-    cv2.destroyAllWindows()
-
-    if embeddings:
-        data = load_embeddings()
-        data[name] = {
-            'embedding': np.mean(embeddings, axis=0),
-            'roll_no': roll_no,
-            'section': section
-        }
-        save_embeddings(data)
+    embeddings = worker.finish()
+    if len(embeddings):
+        update_student_prototypes(name, embeddings, roll_no, section)
         print("[✓] Student registered")
     else:
         print("[!] No embeddings captured")
 
-def mark_attendance_from_video(video_path, section=None):
-    if not os.path.exists(video_path):
-        print("[!] Video not found")
-        return False, None
+def update_student_prototypes(name, embeddings, roll_no=None, section=None, merge=False,
+                              max_prototypes=MAX_PROTOTYPES):
+    """Store new prototype embeddings for one student, leaving everyone else's rows untouched.
 
-    data = load_embeddings()
-    # Filter by section if provided
-    if section is not None:
-        data = {name: info for name, info in data.items() if info.get('section') == section}
-    cap = cv2.VideoCapture(video_path)
-    face_cascade = cv2.CascadeClassifier(HAAR_CASCADE_FILEPATH)
-    marked = set()
-    student_info = {}
+    With `merge` the new samples are pooled with the student's current
+    prototypes before being reduced to at most `max_prototypes` rows. The
+    change is appended to the gallery journal, so its cost does not grow
+    with the gallery.
+    """
+    samples = l2_normalize(np.atleast_2d(embeddings))
+    if merge:
+        gallery = get_gallery(GALLERY_DIR, EMBEDDINGS_FILE)
+        if name in gallery:
+            samples = np.vstack([gallery.prototypes(name), samples])
+    prototypes = make_prototypes(samples, max_prototypes)
+    append_journal({name: {'prototypes': prototypes, 'roll_no': roll_no, 'section': section}}, GALLERY_DIR)
+    refresh_ann_indexes()
+    maybe_compact(GALLERY_DIR)
 
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
+def list_images(folder):
+    """Return the image files directly inside `folder`, sorted by name."""
+    return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.lower().endswith(IMAGE_EXTENSIONS)]
+
+def read_roster(csv_path):
+    """Read a roster CSV with name, roll_no, section and folder columns.
+
+    Headers are matched case-insensitively ("Roll No" works too); relative
+    folders are resolved against the CSV's directory.
+    """
+    base = os.path.dirname(os.path.abspath(csv_path))
+    roster = []
+    with open(csv_path, newline='') as f:
+        for row in csv.DictReader(f):
+            row = {key.strip().lower().replace(' ', '_'): (value or '').strip() for key, value in row.items() if key}
+            if not row.get('name'):
+                continue
+            roster.append({'name': row['name'], 'roll_no': row.get('roll_no'), 'section': row.get('section') or None,
+                           'folder': os.path.join(base, row['folder']) if row.get('folder') else None})
+    return roster
+
+def roster_from_tree(root, section=None):
+    """Build a roster from a folder per student, optionally grouped in folders per section.
+
+    A student folder named "<roll_no>_<name>" provides both fields when the
+    roll number contains a digit; any other name ("Mary_Jane") is taken as
+    the student's name. A folder holding sub-folders but no images of its
+    own is read as a section; an empty student folder stays on the roster
+    so that bulk_register reports it as missing.
+    """
+    roster = []
+    for entry in sorted(os.listdir(root)):
+        path = os.path.join(root, entry)
+        if not os.path.isdir(path):
+            continue
+        if section is None and not list_images(path) and any(e.is_dir() for e in os.scandir(path)):
+            roster.extend(roster_from_tree(path, entry))
+            continue
+        roll_no, _, name = entry.partition('_')
+        if not name or not any(ch.isdigit() for ch in roll_no):
+            roll_no, name = None, entry
+        roster.append({'name': name, 'roll_no': roll_no, 'section': section, 'folder': path})
+    return roster
+
+_detector = threading.local()
+
+def detect_face_crop(img_path):
+    """Return the 160x160 crop of the largest face in an image, None without a face.
+
+    Raises ValueError for files OpenCV cannot read. Safe to call from
+    several threads; each keeps its own cascade.
+    """
+    if not hasattr(_detector, 'cascade'):
+        _detector.cascade = cv2.CascadeClassifier(HAAR_CASCADE_FILEPATH)
+    img = cv2.imread(img_path)
+    if img is None:
+        raise ValueError(f"Could not read image: {img_path}")
+    faces = _detector.cascade.detectMultiScale(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), 1.3, 5)
+    if len(faces) == 0:
+        return None
+    x, y, w, h = max(faces, key=lambda box: box[2] * box[3])
+    return cv2.resize(img[y:y + h, x:x + w], FACE_SIZE)
+
+def bulk_register(roster, workers=ENROLL_WORKERS, batch_size=ENROLL_BATCH_SIZE, merge=False,
+                  max_prototypes=MAX_PROTOTYPES):
+    """Enroll many students from their images and write the gallery once.
+
+    `roster` is a list of {'name', 'roll_no', 'section'} dicts with either a
+    'folder' of images or an 'images' list, e.g. from read_roster or
+    roster_from_tree. Faces are detected and cropped by `workers` threads
+    and embedded in batches of `batch_size`. With `merge` the new samples
+    are pooled with an existing student's prototypes instead of replacing
+    them.
+
+    Returns a report dict: registered names, students without any usable
+    image (missing), images without a face (no_face), unreadable images and
+    the elapsed time.
+    """
+    start_time = time.perf_counter()
+    jobs = []
+    missing = []
+    for i, student in enumerate(roster):
+        images = student.get('images')
+        if images is None:
+            folder = student.get('folder')
+            images = list_images(folder) if folder and os.path.isdir(folder) else []
+        if not images:
+            missing.append(student['name'])
+        jobs.extend((i, path) for path in images)
+    print(f"[i] Enrolling {len(roster)} students from {len(jobs)} images")
+
+    def crop(job):
+        try:
+            return detect_face_crop(job[1]), None
+        except ValueError as e:
+            return None, str(e)
+
+    # Crops go straight into the batcher and only (owner, embedding) pairs are
+    # kept; about two batches of images are in flight at a time
+    batcher = EmbeddingBatcher(batch_size, max_wait=None)
+    samples, no_face, unreadable = {}, [], []
+
+    def collect(tags, embeddings):
+        for i, embedding in zip(tags, embeddings if embeddings is not None else []):
+            samples.setdefault(i, []).append(embedding)
+
+    def handle(job, future):
+        face, error = future.result()
+        if error:
+            unreadable.append(job[1])
+        elif face is None:
+            no_face.append(job[1])
+        else:
+            collect(*batcher.add(face, job[0]))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        pending = deque()
+        for job in jobs:
+            pending.append((job, pool.submit(crop, job)))
+            if len(pending) >= 2 * batcher.batch_size:
+                handle(*pending.popleft())
+        while pending:
+            handle(*pending.popleft())
+    collect(*batcher.flush())
+
+    missing.extend(roster[i]['name'] for i in range(len(roster)) if i not in samples and roster[i]['name'] not in missing)
+
+    def update(gallery):
+        changes = {}
+        for i, rows in samples.items():
+            student = roster[i]
+            rows = l2_normalize(np.stack(rows))
+            if merge and student['name'] in gallery:
+                rows = np.vstack([gallery.prototypes(student['name']), rows])
+            changes[student['name']] = {'prototypes': make_prototypes(rows, max_prototypes),
+                                        'roll_no': student.get('roll_no'), 'section': student.get('section')}
+        return changes
+
+    if samples:
+        rewrite_gallery(GALLERY_DIR, legacy_pickle=EMBEDDINGS_FILE, update=update)
+        refresh_ann_indexes()
+    report = {
+        'registered': [roster[i]['name'] for i in sorted(samples)],
+        'missing': missing,
+        'no_face': no_face,
+        'unreadable': unreadable,
+        'elapsed': time.perf_counter() - start_time,
+    }
+    print(f"[✓] Registered {len(report['registered'])} students from {batcher.embedded} faces "
+          f"in {report['elapsed']:.1f}s")
+    for path in no_face:
+        print(f"[!] No face found in {path}")
+    for path in unreadable:
+        print(f"[!] Could not read {path}")
+    if missing:
+        print(f"[!] No usable images for: {', '.join(missing)}")
+    return report
+
+def frame_stride_for(fps, sample_fps=None, frame_stride=1):
+    """Return how many frames to advance between analysed frames."""
+    if sample_fps and fps and fps > 0:
+        return max(1, int(round(fps / sample_fps)))
+    return max(1, int(frame_stride or 1))
+
+def iter_sampled_frames(cap, stride=1, start_frame=0, end_frame=None):
+    """Yield (frame_idx, timestamp_seconds, frame) for every `stride`-th frame of `cap`.
+
+    Skipped frames are only grabbed, never retrieved, so they are not
+    converted into BGR images. A non-zero `start_frame` seeks first; frames
+    are picked by their absolute index so segments line up with a full run.
+    """
+    fps = cap.get(cv2.CAP_PROP_FPS) or 0.0
+    if start_frame:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    frame_idx = start_frame
+    while end_frame is None or frame_idx < end_frame:
+        if frame_idx % stride:
+            if not cap.grab():
+                break
+        else:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if fps > 0:
+                timestamp = frame_idx / fps
+            else:
+                timestamp = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            yield frame_idx, timestamp, frame
+        frame_idx += 1
+
+class SceneChangeGate:
+    """Cheap check of whether a frame differs from the last analysed one.
+
+    Frames are compared as small grayscale thumbnails; the mean absolute
+    pixel difference (0-255) must reach `threshold` for the frame to pass.
+    """
+
+    def __init__(self, threshold, size=CHANGE_THUMB_SIZE):
+        self.threshold = threshold
+        self.size = size
+        self.reference = None
+        self.gated = 0
+
+    def changed(self, gray):
+        """Return True if `gray` should be analysed, remembering it as the new reference."""
+        thumb = cv2.resize(gray, self.size, interpolation=cv2.INTER_AREA)
+        if self.reference is not None:
+            diff = cv2.absdiff(thumb, self.reference)
+            if float(np.mean(diff)) < self.threshold:
+                self.gated += 1
+                return False
+        self.reference = thumb
+        return True
+
+def box_iou(boxes_a, boxes_b):
+    """Return the IoU matrix between two arrays of (x, y, w, h) boxes."""
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    ax2, ay2 = a[:, 0] + a[:, 2], a[:, 1] + a[:, 3]
+    bx2, by2 = b[:, 0] + b[:, 2], b[:, 1] + b[:, 3]
+    iw = np.clip(np.minimum(ax2[:, None], bx2[None]) - np.maximum(a[:, 0, None], b[None, :, 0]), 0, None)
+    ih = np.clip(np.minimum(ay2[:, None], by2[None]) - np.maximum(a[:, 1, None], b[None, :, 1]), 0, None)
+    inter = iw * ih
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None] - inter
+    return inter / np.maximum(union, 1e-6)
+
+class FaceTrack:
+    """One face followed across analysed frames."""
+
+    def __init__(self, track_id, box):
+        self.id = track_id
+        self.box = box
+        self.missed = 0
+        self.embeds = 0
+        self.votes = []
+        self.identity = None
+        self.score = 0.0
+        self.resolved = False
+        self.retry_at = None  # tracker frame at which an unidentified track is embedded again
+
+class FaceTracker:
+    """Links Haar boxes across frames by IoU so each face is embedded only a few times.
+
+    A track is embedded until one match reaches `confident_score`, or up to
+    `max_embeds` times, after which its identity is the majority vote of the
+    matches above MATCH_THRESHOLD. Identified tracks are followed without
+    calling FaceNet again. A track that ends up unidentified (blurred or
+    turned away while it was embedded) starts over after `retry_frames`
+    analysed frames, so a student is not lost for the rest of the video.
+    """
+
+    def __init__(self, iou_threshold=TRACK_IOU, max_missed=TRACK_MAX_MISSED,
+                 max_embeds=TRACK_MAX_EMBEDS, confident_score=TRACK_CONFIDENT_SCORE,
+                 retry_frames=TRACK_RETRY_FRAMES):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.max_embeds = max_embeds
+        self.confident_score = confident_score
+        self.retry_frames = retry_frames
+        self.active = []
+        self.tracks = {}
+        self.next_id = 0
+        self.frame = 0
+        self.reused = 0
+
+    def update(self, boxes):
+        """Assign each box of the current frame to a track and return the tracks in box order."""
+        self.frame += 1
+        assigned = [None] * len(boxes)
+        taken = set()
+        if self.active and len(boxes):
+            iou = box_iou([t.box for t in self.active], boxes)
+            # Greedy assignment, best overlap first
+            for flat in np.argsort(-iou, axis=None):
+                ti, bi = np.unravel_index(flat, iou.shape)
+                if iou[ti, bi] < self.iou_threshold:
+                    break
+                if assigned[bi] is None and ti not in taken:
+                    assigned[bi] = self.active[ti]
+                    taken.add(ti)
+        for ti, track in enumerate(self.active):
+            track.missed = 0 if ti in taken else track.missed + 1
+        for bi, box in enumerate(boxes):
+            if assigned[bi] is None:
+                assigned[bi] = FaceTrack(self.next_id, box)
+                self.tracks[self.next_id] = assigned[bi]
+                self.active.append(assigned[bi])
+                self.next_id += 1
+            assigned[bi].box = box
+        self.active = [t for t in self.active if t.missed <= self.max_missed]
+        return assigned
+
+    def needs_embedding(self, track):
+        """Return True if the track's face should be sent to FaceNet in this frame."""
+        if track.resolved and track.identity is None and track.retry_at is not None and self.frame >= track.retry_at:
+            # Unidentified so far: collect a fresh set of votes
+            track.resolved = False
+            track.retry_at = None
+            track.embeds = 0
+            track.votes = []
+        if track.resolved or track.embeds >= self.max_embeds:
+            self.reused += 1
+            return False
+        track.embeds += 1
+        return True
 
+    def awaiting_votes(self, track_id):
+        """Return True if the track is unresolved but will not be embedded again.
+
+        Only the matches of its crops still queued for FaceNet can resolve it.
+        """
+        track = self.tracks[track_id]
+        return not track.resolved and track.embeds >= self.max_embeds
+
+    def record(self, track_id, match):
+        """Add a match for a track; return the track if this resolved it to a student."""
+        track = self.tracks[track_id]
+        if track.resolved:
+            return None
+        track.votes.append(match)
+        if match.score >= self.confident_score:
+            return self._resolve(track, match.name)
+        if len(track.votes) >= self.max_embeds:
+            return self._resolve(track, self._vote(track))
+        return None
+
+    def finalize(self):
+        """Resolve every track still waiting for votes; return those identified."""
+        resolved = []
+        for track in self.tracks.values():
+            if not track.resolved and track.votes:
+                if self._resolve(track, self._vote(track)):
+                    resolved.append(track)
+        return resolved
+
+    def _vote(self, track):
+        counts = Counter(m.name for m in track.votes if m.score > MATCH_THRESHOLD)
+        if not counts:
+            return None
+        best_score = {}
+        for m in track.votes:
+            best_score[m.name] = max(best_score.get(m.name, 0.0), m.score)
+        return max(counts, key=lambda name: (counts[name], best_score[name]))
+
+    def _resolve(self, track, name):
+        track.resolved = True
+        track.identity = name
+        if name is None:
+            track.retry_at = self.frame + self.retry_frames
+            return None
+        track.score = max(m.score for m in track.votes if m.name == name)
+        return track
+
+_STAGE_DONE = object()
+
+def run_stage_in_thread(items, stop_event, maxsize=PIPELINE_QUEUE_SIZE):
+    """Run the generator `items` in a thread and yield its output through a bounded queue.
+
+    The producer blocks while the queue is full, so memory use does not grow
+    with the length of the video. Setting `stop_event` (or closing this
+    generator) makes the producer stop at the next item.
+    """
+    q = queue.Queue(maxsize=maxsize)
+    errors = []
+
+    def put(item):
+        while not stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(item):
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.close()
+            put(_STAGE_DONE)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+            except queue.Empty:
+                if not thread.is_alive() and q.empty():
+                    break
+                continue
+            if item is _STAGE_DONE:
+                break
+            yield item
+    finally:
+        if thread.is_alive():
+            stop_event.set()
+        thread.join()
+    if errors:
+        raise errors[0]
+
+def _decode_stage(cap, stride, start_frame, end_frame, gate, decoded):
+    # Yields (frame_idx, timestamp, frame, gray) for the frames that pass sampling and gating.
+    # With a pipeline this runs ahead of the consumer, so it only notes the last
+    # sampled frame and the gated ones in `decoded`; the consumer keeps the stats.
+    for frame_idx, timestamp, frame in iter_sampled_frames(cap, stride, start_frame, end_frame):
+        decoded['frame'], decoded['timestamp'] = frame_idx, round(timestamp, 3)
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        # Static scene: the faces in it were already seen in the last analysed frame
+        if gate is not None and not gate.changed(gray):
+            decoded['gated'].append(frame_idx)
+            continue
+        yield frame_idx, timestamp, frame, gray
+
+def _detect_stage(frames, face_cascade, tracker):
+    # Yields (frame_idx, timestamp, faces detected, [(tag, 160x160 crop), ...]) with the faces that need embedding
+    for frame_idx, timestamp, frame, gray in frames:
         faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+        tracks = tracker.update([tuple(box) for box in faces]) if tracker is not None else [None] * len(faces)
+        crops = []
+        for (x, y, w, h), track in zip(faces, tracks):
+            if track is not None and not tracker.needs_embedding(track):
+                continue
+            face = cv2.resize(frame[y:y + h, x:x + w], FACE_SIZE)
+            crops.append((track.id if track is not None else frame_idx, face))
+        yield frame_idx, timestamp, len(faces), crops
+
+def scan_video(video_path, matcher, start_frame=0, end_frame=None, batch_size=EMBED_BATCH_SIZE,
+               max_wait=EMBED_MAX_WAIT, sample_fps=None, frame_stride=1, change_threshold=None,
+               track_faces=False, stop_when_complete=False, saturation_window=None, pipeline=False,
+               queue_size=PIPELINE_QUEUE_SIZE, cancel_event=None):
+    """Recognise the students of `matcher` in frames [start_frame, end_frame) of a video.
+
+    Returns (best_scores, stats) where best_scores maps every recognised
+    student to the highest match score seen. See mark_attendance_from_video
+    for the options.
+    """
+    events = iter_scan_events(video_path, matcher, start_frame=start_frame, end_frame=end_frame,
+                              batch_size=batch_size, max_wait=max_wait, sample_fps=sample_fps,
+                              frame_stride=frame_stride, change_threshold=change_threshold, track_faces=track_faces,
+                              stop_when_complete=stop_when_complete, saturation_window=saturation_window,
+                              pipeline=pipeline, queue_size=queue_size, cancel_event=cancel_event)
+    while True:
+        try:
+            next(events)
+        except StopIteration as done:
+            return done.value
+
+def iter_scan_events(video_path, matcher, start_frame=0, end_frame=None, batch_size=EMBED_BATCH_SIZE,
+                     max_wait=EMBED_MAX_WAIT, sample_fps=None, frame_stride=1, change_threshold=None,
+                     track_faces=False, stop_when_complete=False, saturation_window=None, pipeline=False,
+                     queue_size=PIPELINE_QUEUE_SIZE, cancel_event=None):
+    """Generator behind scan_video: yields progress, marked and unknown events while scanning.
+
+    The events are the dicts described in iter_attendance_events. Setting
+    `cancel_event` stops the scan with stop_reason 'cancelled'. The
+    generator's return value is scan_video's (best_scores, stats).
+    """
+    cap = cv2.VideoCapture(video_path)
+    face_cascade = cv2.CascadeClassifier(HAAR_CASCADE_FILEPATH)
+    batcher = EmbeddingBatcher(batch_size, max_wait)
+    roster = set(matcher.names)
+    fallback_before = getattr(matcher, 'fallback_lookups', 0)
+    best_scores = {}
+    first_seen = {}
+    first_seen_frame = {}
+    fps = cap.get(cv2.CAP_PROP_FPS) or 0.0
+    stride = frame_stride_for(fps, sample_fps, frame_stride)
+    gate = SceneChangeGate(change_threshold) if change_threshold else None
+    tracker = FaceTracker() if track_faces else None
+    stats = {
+        'fps': fps,
+        'frame_stride': stride,
+        'frames_total': int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0),
+        'frames_analysed': 0,
+        'timestamps': [],
+        'faces_detected': 0,
+        'stop_reason': 'end_of_video',
+        'stop_frame': None,
+        'stop_timestamp': None,
+    }
+    frame_times = {}  # tag -> (frame_idx, timestamp) where the face was first seen
+    pending = []  # events raised while matching, yielded after each frame
+
+    def mark(name, score, tag):
+        frame_idx, timestamp = frame_times.get(tag, (None, None))
+        if name not in best_scores:
+            first_seen[name] = timestamp
+            first_seen_frame[name] = frame_idx
+            info = matcher.info[name]
+            pending.append({'type': 'marked', 'name': name, 'roll_no': info['roll_no'], 'section': info['section'],
+                            'score': float(score), 'frame': frame_idx, 'timestamp': timestamp})
+        best_scores[name] = max(best_scores.get(name, 0.0), score)
+
+    def unknown(score, tag):
+        frame_idx, timestamp = frame_times.get(tag, (None, None))
+        pending.append({'type': 'unknown', 'score': float(score), 'frame': frame_idx, 'timestamp': timestamp})
+
+    def mark_batch(tags, embeddings):
+        if embeddings is None:
+            return
+        for tag, match in zip(tags, matcher.match(embeddings)):
+            if tracker is not None:
+                was_resolved = tracker.tracks[tag].resolved
+                track = tracker.record(tag, match)
+                if track is not None:
+                    mark(track.identity, track.score, tag)
+                elif not was_resolved and tracker.tracks[tag].resolved:
+                    unknown(match.score, tag)
+            # Only mark if above threshold; below it the face is treated as unknown
+            elif match.score > MATCH_THRESHOLD:
+                mark(match.name, match.score, tag)
+            else:
+                unknown(match.score, tag)
+
+    # Decode and detection either run inline or, with `pipeline`, each in its
+    # own thread so they overlap with FaceNet inference in this one
+    stop_event = threading.Event()
+    decoded = {'frame': None, 'timestamp': None, 'gated': []}
+    frames = _decode_stage(cap, stride, start_frame, end_frame, gate, decoded)
+    if pipeline:
+        frames = run_stage_in_thread(frames, stop_event, queue_size)
+    detections = _detect_stage(frames, face_cascade, tracker)
+    if pipeline:
+        detections = run_stage_in_thread(detections, stop_event, queue_size)
+
+    since_new = 0
+    start_time = time.perf_counter()
+    try:
+        for frame_idx, timestamp, face_count, crops in detections:
+            # Counted here rather than in the stages, which may run ahead of this loop
+            stats['stop_frame'], stats['stop_timestamp'] = frame_idx, round(timestamp, 3)
+            stats['frames_analysed'] += 1
+            stats['timestamps'].append(round(timestamp, 3))
+            stats['faces_detected'] += face_count
+            marked_before = len(best_scores)
+            for tag, face in crops:
+                frame_times.setdefault(tag, (frame_idx, round(timestamp, 3)))
+                mark_batch(*batcher.add(face, tag))
+            if tracker is not None and any(tracker.awaiting_votes(tag) for tag, _ in crops):
+                # A track just queued its last crop; its identity depends on this batch
+                mark_batch(*batcher.flush())
+            # Frames without new crops must not hold back a partial batch
+            mark_batch(*batcher.poll())
 
-        for (x, y, w, h) in faces:
-            face = frame[y:y + h, x:x + w]
-            face = cv2.resize(face, (160, 160))
-            emb = embedder.embeddings([face])[0]
-
-            best_match, best_score = None, 0.0
-            for name, info in data.items():
-                score = cosine_similarity([emb], [info['embedding']])[0][0]
-                if score > best_score:
-                    best_score = score
-                    best_match = name
-                    student_info[name] = info
-
-            # Only mark if above threshold and not already marked
-            if best_score > 0.5 and best_match not in marked:
-                marked.add(best_match)
-            # If below threshold, treat as unknown (do not mark)
-            # Optionally, you could log or count unknowns here
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
+            # The window only starts with the first recognised student, so an
+            # empty room at the start of a recording does not end the scan
+            if len(best_scores) > marked_before:
+                since_new = 0
+            elif best_scores:
+                since_new += 1
+            stop_reason = None
+            if saturation_window and since_new >= saturation_window:
+                # Crops still waiting for their batch may hold a new student
+                mark_batch(*batcher.flush())
+                if len(best_scores) == marked_before:
+                    stop_reason = 'saturated'
+                since_new = 0
+            # Students recognised through a fallback matcher are not on the roster
+            if stop_when_complete and roster and roster.issubset(best_scores):
+                stop_reason = 'roster_complete'
+            if cancel_event is not None and cancel_event.is_set():
+                stop_reason = 'cancelled'
+
+            yield from pending
+            pending.clear()
+            elapsed = time.perf_counter() - start_time
+            yield {'type': 'progress', 'frame': frame_idx, 'timestamp': round(timestamp, 3),
+                   'frames_total': stats['frames_total'], 'frames_analysed': stats['frames_analysed'],
+                   'fps': stats['frames_analysed'] / elapsed if elapsed > 0 else 0.0}
+            if stop_reason:
+                stats['stop_reason'] = stop_reason
+                break
+    finally:
+        stop_event.set()
+        detections.close()
+        cap.release()
+
+    # End of video: embed whatever is still queued
+    if stats['stop_reason'] != 'cancelled':
+        mark_batch(*batcher.flush())
+        if tracker is not None:
+            waiting = [track for track in tracker.tracks.values() if not track.resolved and track.votes]
+            for track in tracker.finalize():
+                mark(track.identity, track.score, track.id)
+            for track in waiting:
+                if track.identity is None:
+                    unknown(max(m.score for m in track.votes), track.id)
+        yield from pending
+        pending.clear()
+    if stats['stop_reason'] == 'end_of_video':
+        # Trailing gated frames were still read; the scan ends at the last sampled frame
+        if decoded['frame'] is not None:
+            stats['stop_frame'], stats['stop_timestamp'] = decoded['frame'], decoded['timestamp']
+        stats['frames_gated'] = len(decoded['gated'])
+    else:
+        stats['frames_gated'] = sum(1 for i in decoded['gated'] if i < stats['stop_frame'])
+    stats['tracks'] = len(tracker.tracks) if tracker is not None else 0
+    stats['faces_reused'] = tracker.reused if tracker is not None else 0
+    stats['faces_embedded'] = batcher.embedded
+    stats['embedding_calls'] = batcher.calls
+    stats['fallback_lookups'] = getattr(matcher, 'fallback_lookups', 0) - fallback_before
+    stats['first_seen'] = first_seen
+    stats['first_seen_frame'] = first_seen_frame
+    stats['elapsed'] = time.perf_counter() - start_time
+    return best_scores, stats
+
+def plan_segments(frame_count, fps, segment_seconds):
+    """Split [0, frame_count) into (start_frame, end_frame) ranges of about `segment_seconds`.
+
+    The last range ends at None, so frames beyond a wrong container frame
+    count are still read.
+    """
+    if frame_count <= 0:
+        return [(0, None)]
+    length = max(1, int(round(segment_seconds * fps))) if fps > 0 else frame_count
+    starts = list(range(0, frame_count, length))
+    return [(start, end) for start, end in zip(starts, starts[1:] + [None])]
+
+# Set in each segment worker process; the parent sets it to stop running segments
+_segment_stop = None
+
+def _init_segment_worker(stop_event):
+    global _segment_stop
+    _segment_stop = stop_event
+
+def _scan_segment(video_path, matcher_args, start_frame, end_frame, options):
+    # Runs in a worker process, which builds its own matcher and FaceNet from
+    # the same gallery snapshot as the parent, even if it was edited since
+    matcher = get_matcher(*matcher_args)
+    return scan_video(video_path, matcher, start_frame, end_frame, cancel_event=_segment_stop, **options)
+
+def merge_scan_results(results):
+    """Merge the (best_scores, stats) of consecutive segments into one result.
+
+    The stop fields come from the last segment, i.e. the end of the video;
+    a run stopped early (roster complete, cancelled) is reported by the caller.
+    """
+    best_scores, first_seen, first_seen_frame = {}, {}, {}
+    stats = {'timestamps': []}
+    counters = ['frames_analysed', 'faces_detected', 'frames_gated', 'tracks', 'faces_reused',
+                'faces_embedded', 'embedding_calls', 'fallback_lookups']
+    for key in counters:
+        stats[key] = 0
+    for scores, seg_stats in results:
+        for name, score in scores.items():
+            best_scores[name] = max(best_scores.get(name, 0.0), score)
+            if name not in first_seen:
+                first_seen[name] = seg_stats['first_seen'].get(name)
+                first_seen_frame[name] = seg_stats['first_seen_frame'].get(name)
+        for key in counters:
+            stats[key] += seg_stats[key]
+        stats['timestamps'].extend(seg_stats['timestamps'])
+        stats['elapsed'] = max(stats.get('elapsed', 0.0), seg_stats['elapsed'])
+    last = results[-1][1]
+    for key in ['fps', 'frame_stride', 'frames_total', 'stop_reason', 'stop_frame', 'stop_timestamp']:
+        stats[key] = last[key]
+    stats['first_seen'] = first_seen
+    stats['first_seen_frame'] = first_seen_frame
+    stats['segments'] = len(results)
+    return best_scores, stats
+
+def write_attendance_csv(marked, student_info, section, cross_section=None):
+    """Write the attendance CSV for the `marked` students and return its path.
+
+    With a `cross_section` collection of names, a Cross Section column flags
+    the students who are registered in a different section. Names carry
+    the minute; a second file for the same section and minute (e.g. from a
+    batch run) gets a numbered suffix instead of replacing the first.
+    """
+    section_str = section if section else 'ALL'
+    stem = f"{ATTENDANCE_DIR}/attendance_{section_str}_{datetime.now().strftime('%Y-%m-%d_%H-%M')}"
+    filename, n = f"{stem}.csv", 1
+    while True:
+        try:
+            f = open(filename, 'x')
             break
+        except FileExistsError:
+            n += 1
+            filename = f"{stem}_{n}.csv"
+    with f:
+        f.write("Name,Roll No,Section,Timestamp" + (",Cross Section" if cross_section is not None else "") + "\n")
+        for name in marked:
+            info = student_info[name]
+            line = f"{name},{info['roll_no']},{info['section']},{datetime.now().strftime('%H:%M:%S')}"
+            if cross_section is not None:
+                line += ",Yes" if name in cross_section else ",No"
+            f.write(line + "\n")
+    return filename
+
+def mark_attendance_from_video(video_path, section=None, batch_size=EMBED_BATCH_SIZE, max_wait=EMBED_MAX_WAIT,
+                               sample_fps=None, frame_stride=1, change_threshold=None, track_faces=False,
+                               stop_when_complete=False, saturation_window=None, workers=1,
+                               segment_seconds=None, pipeline=False, queue_size=PIPELINE_QUEUE_SIZE,
+                               search='exact', fallback=False, cancel_event=None, return_stats=False):
+    """Mark attendance for `section` from a recorded video and save it as a CSV.
+
+    Face crops from consecutive frames are embedded together in batches of
+    `batch_size`; a partial batch is embedded once its oldest crop has waited
+    `max_wait` seconds and at the end of the video.
+
+    By default every frame is analysed. `sample_fps` analyses roughly that
+    many frames per second of video, and `frame_stride` analyses every n-th
+    frame when the video reports no frame rate or `sample_fps` is not given.
+    With `change_threshold` set, sampled frames whose downscaled grayscale
+    image differs from the last analysed frame by less than that mean pixel
+    value are skipped before face detection. `track_faces` follows faces
+    across analysed frames with a FaceTracker so each person is embedded a
+    few times instead of in every frame.
+
+    Processing can end before the last frame: `stop_when_complete` stops as
+    soon as every student of the section is marked, and `saturation_window`
+    stops once that many analysed frames pass without a new student, counted
+    from the first student recognised. The stats record why (stop_reason)
+    and where (stop_frame, stop_timestamp).
+
+    With `workers` > 1 and `segment_seconds` set, the video is cut into
+    segments of that length which are processed by a pool of worker
+    processes and merged. Analysed frames are the same as in a sequential
+    run; scene gating and tracking restart at each segment boundary. With
+    `stop_when_complete`, all segments stop once the merged roster is
+    complete. `saturation_window` depends on the order of first sightings
+    across the whole video and cannot be combined with segments.
+
+    `pipeline` runs decoding and face detection in their own threads,
+    connected to FaceNet inference by queues of at most `queue_size` frames,
+    so the stages overlap while memory stays bounded.
+
+    `search` selects exact matching or the approximate 'ivf' index (see
+    get_matcher), which pays off for large galleries such as section=None.
+
+    With `fallback`, faces that match no one in `section` are looked up in
+    the whole gallery, so students attending from another section are
+    marked too. They are listed in stats['cross_section'] and flagged in
+    the CSV's Cross Section column.
+
+    Setting `cancel_event` abandons the run without writing a CSV. This is
+    a thin consumer of iter_attendance_events, which reports progress while
+    the video is processed.
+
+    Returns (success, marked_students), or (success, marked_students, stats)
+    when `return_stats` is set.
+    """
+    finished = None
+    for event in iter_attendance_events(video_path, section, batch_size=batch_size, max_wait=max_wait,
+                                        sample_fps=sample_fps, frame_stride=frame_stride,
+                                        change_threshold=change_threshold, track_faces=track_faces,
+                                        stop_when_complete=stop_when_complete,
+                                        saturation_window=saturation_window, workers=workers,
+                                        segment_seconds=segment_seconds, pipeline=pipeline, queue_size=queue_size,
+                                        search=search, fallback=fallback, cancel_event=cancel_event):
+        if event['type'] == 'finished':
+            finished = event
+    if return_stats:
+        return finished['success'], finished['marked_students'], finished['stats']
+    return finished['success'], finished['marked_students']
+
+def iter_attendance_events(video_path, section=None, batch_size=EMBED_BATCH_SIZE, max_wait=EMBED_MAX_WAIT,
+                           sample_fps=None, frame_stride=1, change_threshold=None, track_faces=False,
+                           stop_when_complete=False, saturation_window=None, workers=1,
+                           segment_seconds=None, pipeline=False, queue_size=PIPELINE_QUEUE_SIZE,
+                           search='exact', fallback=False, cancel_event=None):
+    """Process a recorded video like mark_attendance_from_video, yielding events as it goes.
+
+    Every event is a dict with a 'type':
 
-    cap.release()
-    cv2.destroyAllWindows()
-
-    if marked:
-        section_str = section if section else 'ALL'
-        filename = f"{ATTENDANCE_DIR}/attendance_{section_str}_{datetime.now().strftime('%Y-%m-%d_%H-%M')}.csv"
-        with open(filename, 'w') as f:
-            f.write("Name,Roll No,Section,Timestamp\n")
-            for name in marked:
-                info = student_info[name]
-                f.write(f"{name},{info['roll_no']},{info['section']},{datetime.now().strftime('%H:%M:%S')}\n")
-        print(f"[✓] Attendance saved to {filename}")
-        # Prepare marked students list for GUI
-        marked_students = [(name, student_info[name]['roll_no']) for name in marked]
-        return True, marked_students
+    - 'progress': frame, timestamp, frames_total, frames_analysed and the
+      processing rate fps, after each analysed frame
+    - 'marked': name, roll_no, section, score, frame and timestamp of a
+      student recognised for the first time
+    - 'unknown': score, frame and timestamp of a face that matched no one
+    - 'finished': success, marked_students and stats, always last
+
+    With worker processes (`workers` and `segment_seconds`) progress and
+    marked events arrive per finished segment instead. Setting
+    `cancel_event` stops processing; the run then finishes unsuccessfully
+    and writes no CSV, with the partial stats['scores'].
+    """
+    if saturation_window and workers > 1 and segment_seconds:
+        raise ValueError("saturation_window cannot be combined with segments (workers and segment_seconds)")
+    if not os.path.exists(video_path):
+        print("[!] Video not found")
+        yield {'type': 'finished', 'success': False, 'marked_students': None, 'stats': None}
+        return
+
+    gallery = get_gallery(GALLERY_DIR, EMBEDDINGS_FILE)
+    matcher_args = (section, search, gallery.pin, fallback)
+    matcher = get_matcher(*matcher_args)
+    options = dict(batch_size=batch_size, max_wait=max_wait, sample_fps=sample_fps, frame_stride=frame_stride,
+                   change_threshold=change_threshold, track_faces=track_faces,
+                   stop_when_complete=stop_when_complete, saturation_window=saturation_window,
+                   pipeline=pipeline, queue_size=queue_size)
+    segments = [(0, None)]
+    if workers > 1 and segment_seconds:
+        cap = cv2.VideoCapture(video_path)
+        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+        segments = plan_segments(frame_count, cap.get(cv2.CAP_PROP_FPS) or 0.0, segment_seconds)
+        cap.release()
+
+    if len(segments) > 1:
+        best_scores, stats = yield from _iter_segment_events(video_path, matcher_args, segments, frame_count,
+                                                             workers, options, matcher, cancel_event)
     else:
-        return False, None
-    
-def test_accuracy(test_images, true_labels, section=None):
-    data = load_embeddings()
-    if section is not None:
-        data = {name: info for name, info in data.items() if info.get('section') == section}
-    correct = 0
-    total = len(test_images)
+        best_scores, stats = yield from iter_scan_events(video_path, matcher, cancel_event=cancel_event, **options)
+
+    stats['scores'] = best_scores
+    if stats['stop_reason'] == 'cancelled':
+        print("[!] Attendance processing cancelled")
+        stats['cross_section'] = []
+        yield {'type': 'finished', 'success': False, 'marked_students': None, 'stats': stats}
+        return
+    marked_students = finalize_attendance(best_scores, matcher.info, section, fallback, stats)
+    yield {'type': 'finished', 'success': bool(best_scores), 'marked_students': marked_students, 'stats': stats}
+
+def _iter_segment_events(video_path, matcher_args, segments, frame_count, workers, options, matcher, cancel_event):
+    # Segment results come back whole, so events are produced per finished segment
+    start_time = time.perf_counter()
+    results = {}
+    marked = set()
+    roster = set(matcher.names)
+    # Workers are spawned: forking after TensorFlow has loaded (or from a GUI
+    # thread) can deadlock the children
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                               initializer=_init_segment_worker, initargs=(stop,))
+    cancelled = complete = False
+    try:
+        futures = {pool.submit(_scan_segment, video_path, matcher_args, start, end, options): i
+                   for i, (start, end) in enumerate(segments)}
+        remaining = set(futures)
+        while remaining:
+            done, remaining = wait(remaining, timeout=0.2, return_when=FIRST_COMPLETED)
+            if cancel_event is not None and cancel_event.is_set():
+                cancelled = True
+                stop.set()
+                break
+            for future in done:
+                scores, seg_stats = results[futures[future]] = future.result()
+                for name in sorted(scores, key=lambda name: seg_stats['first_seen'].get(name) or 0.0):
+                    if name not in marked:
+                        marked.add(name)
+                        info = matcher.info[name]
+                        yield {'type': 'marked', 'name': name, 'roll_no': info['roll_no'],
+                               'section': info['section'], 'score': float(scores[name]),
+                               'frame': seg_stats['first_seen_frame'].get(name),
+                               'timestamp': seg_stats['first_seen'].get(name)}
+                analysed = sum(r[1]['frames_analysed'] for r in results.values())
+                elapsed = time.perf_counter() - start_time
+                yield {'type': 'progress', 'frame': seg_stats['stop_frame'], 'timestamp': seg_stats['stop_timestamp'],
+                       'frames_total': frame_count, 'frames_analysed': analysed,
+                       'fps': analysed / elapsed if elapsed > 0 else 0.0,
+                       'segments_done': len(results), 'segments_total': len(segments)}
+            # Students recognised through a fallback matcher are not on the roster
+            if options.get('stop_when_complete') and roster and roster.issubset(marked):
+                complete = True
+                stop.set()
+                break
+    finally:
+        pool.shutdown(wait=not cancelled, cancel_futures=True)
+    if complete:
+        # Segments that were still running stopped at their next frame; keep what they saw
+        for future, i in futures.items():
+            if i not in results and future.done() and not future.cancelled() and future.exception() is None:
+                results[i] = future.result()
+    if results:
+        best_scores, stats = merge_scan_results([results[i] for i in sorted(results)])
+    else:
+        best_scores, stats = {}, {'frames_analysed': 0, 'timestamps': [], 'first_seen': {}, 'first_seen_frame': {}}
+    stats['elapsed'] = time.perf_counter() - start_time
+    if cancelled:
+        stats['stop_reason'] = 'cancelled'
+    elif complete:
+        # Report where a sequential scan would have stopped: at the first
+        # sighting of the student who completed the roster
+        last = max(roster, key=lambda name: stats['first_seen'].get(name) or 0.0)
+        stats['stop_reason'] = 'roster_complete'
+        stats['stop_frame'] = stats['first_seen_frame'].get(last)
+        stats['stop_timestamp'] = stats['first_seen'].get(last)
+        if stats['stop_timestamp'] is not None:
+            stats['timestamps'] = [t for t in stats['timestamps'] if t <= stats['stop_timestamp']]
+            stats['frames_analysed'] = len(stats['timestamps'])
+    return best_scores, stats
+
+def finalize_attendance(best_scores, student_info, section, fallback, stats):
+    """Write the attendance CSV for the students in `best_scores`.
+
+    Records cross-section students in stats['cross_section'] and returns
+    the (name, roll_no) list shown by the GUI, or None if nobody was marked.
+    """
+    marked = list(best_scores)
+    cross_section = None
+    if fallback and section is not None:
+        cross_section = [name for name in marked if str(student_info[name]['section']) != str(section)]
+        if cross_section:
+            print(f"[i] {len(cross_section)} student(s) from other sections recognised")
+    stats['cross_section'] = cross_section or []
+    if not marked:
+        return None
+    filename = write_attendance_csv(marked, student_info, section, cross_section)
+    stats['csv_path'] = filename
+    print(f"[✓] Attendance saved to {filename}")
+    return [(name, student_info[name]['roll_no']) for name in marked]
+
+class LatestFrameReader:
+    """Reads a capture on its own thread and keeps only the newest frame.
+
+    A live source produces frames whether or not recognition keeps up, so
+    processing always takes the freshest one; frames it never got to are
+    counted in `dropped`. With `realtime` a file is replayed at its own
+    frame rate instead of as fast as it decodes.
+    """
+
+    def __init__(self, cap, realtime=False):
+        self.cap = cap
+        self.realtime = realtime
+        self.fps = cap.get(cv2.CAP_PROP_FPS) or 0.0
+        self.cond = threading.Condition()
+        self.item = None
+        self.done = False
+        self.frames_read = 0
+        self.dropped = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="live-capture", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        start = time.monotonic()
+        frame_idx = 0
+        while not self.stop_event.is_set():
+            if self.realtime and self.fps > 0:
+                delay = start + frame_idx / self.fps - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            ret, frame = self.cap.read()
+            if not ret:
+                break
+            with self.cond:
+                if self.item is not None:
+                    self.dropped += 1
+                self.item = (frame_idx, time.monotonic(), frame)
+                self.frames_read += 1
+                self.cond.notify()
+            frame_idx += 1
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def latest(self, timeout=0.5):
+        """Return the newest unprocessed (frame_idx, capture_time, frame), or None if none arrived in time."""
+        with self.cond:
+            if self.item is None and not self.done:
+                self.cond.wait(timeout)
+            item, self.item = self.item, None
+            return item
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+def summarize_latencies(latencies):
+    """Return mean, p50, p95 and max of per-frame latencies, in milliseconds."""
+    if not latencies:
+        return {'mean_ms': None, 'p50_ms': None, 'p95_ms': None, 'max_ms': None}
+    ms = np.asarray(latencies) * 1000.0
+    return {'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+            'p95_ms': float(np.percentile(ms, 95)), 'max_ms': float(ms.max())}
+
+def mark_attendance_live(source=0, section=None, duration=None, sample_fps=LIVE_SAMPLE_FPS, realtime=None,
+                         search='exact', fallback=False, on_mark=None, stop_event=None, show_preview=False,
+                         return_stats=False):
+    """Mark attendance continuously from a camera or stream until stopped.
+
+    `source` is a camera index, a stream URL or a video file; a file is
+    replayed at real-time speed unless `realtime` is False. Frames are
+    analysed at up to `sample_fps` per second, always the newest one, and
+    a student is marked as soon as a face matches them above
+    MATCH_THRESHOLD: `on_mark(name, info, score, seconds_since_start)` is
+    called right away. The session ends after `duration` seconds, when
+    `stop_event` is set, when the source ends or when q is pressed in the
+    preview, and is then written to the usual attendance CSV.
+
+    stats['latency'] summarises the time from frame capture to its faces
+    being matched. Returns (success, marked_students), or
+    (success, marked_students, stats) when `return_stats` is set.
+    """
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        print("[!] Camera error")
+        return (False, None, None) if return_stats else (False, None)
+    if realtime is None:
+        realtime = isinstance(source, str) and os.path.isfile(source)
+
+    matcher = get_matcher(section, search, fallback=fallback)
+    face_cascade = cv2.CascadeClassifier(HAAR_CASCADE_FILEPATH)
+    reader = LatestFrameReader(cap, realtime)
+    interval = 1.0 / sample_fps if sample_fps else 0.0
+    best_scores, first_seen, latencies = {}, {}, []
+    stats = {'frames_analysed': 0, 'faces_detected': 0, 'unknown_faces': 0, 'stop_reason': 'end_of_stream'}
+    session_start = time.monotonic()
+    next_due = session_start
+    print(f"[i] Live attendance started for section {section if section else 'ALL'}")
+
+    try:
+        while True:
+            now = time.monotonic()
+            if stop_event is not None and stop_event.is_set():
+                stats['stop_reason'] = 'stopped'
+                break
+            if duration is not None and now - session_start >= duration:
+                stats['stop_reason'] = 'duration'
+                break
+            if now < next_due:
+                time.sleep(min(next_due - now, 0.05))
+                continue
+            item = reader.latest()
+            if item is None:
+                if reader.done:
+                    break
+                continue
+            _, captured, frame = item
+            next_due = max(next_due + interval, time.monotonic() - interval)
+
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+            stats['frames_analysed'] += 1
+            stats['faces_detected'] += len(faces)
+            if len(faces):
+                crops = [cv2.resize(frame[y:y + h, x:x + w], FACE_SIZE) for (x, y, w, h) in faces]
+                for match in matcher.match(embed_faces(crops)):
+                    if match.score <= MATCH_THRESHOLD:
+                        stats['unknown_faces'] += 1
+                        continue
+                    if match.name not in best_scores:
+                        first_seen[match.name] = round(time.monotonic() - session_start, 3)
+                        print(f"[✓] Marked {match.name} ({match.score:.2f})")
+                        if on_mark is not None:
+                            on_mark(match.name, matcher.info[match.name], match.score, first_seen[match.name])
+                    best_scores[match.name] = max(best_scores.get(match.name, 0.0), match.score)
+            latencies.append(time.monotonic() - captured)
+
+            if show_preview:
+                for (x, y, w, h) in faces:
+                    cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+                cv2.putText(frame, f"Marked: {len(best_scores)}", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                cv2.imshow("Live Attendance", frame)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    stats['stop_reason'] = 'stopped'
+                    break
+    except KeyboardInterrupt:
+        stats['stop_reason'] = 'stopped'
+    finally:
+        reader.stop()
+        cap.release()
+        if show_preview:
+            cv2.destroyAllWindows()
+
+    stats['elapsed'] = time.monotonic() - session_start
+    stats['frames_read'] = reader.frames_read
+    stats['frames_dropped'] = reader.dropped
+    stats['first_seen'] = first_seen
+    stats['latencies'] = latencies
+    stats['latency'] = summarize_latencies(latencies)
+    stats['scores'] = best_scores
+    if latencies:
+        print(f"[i] Latency per analysed frame: mean {stats['latency']['mean_ms']:.0f} ms, "
+              f"p95 {stats['latency']['p95_ms']:.0f} ms over {len(latencies)} frames")
+    marked_students = finalize_attendance(best_scores, matcher.info, section, fallback, stats)
+    if return_stats:
+        return bool(best_scores), marked_students, stats
+    return bool(best_scores), marked_students
+
+def embed_test_images(test_images, true_labels):
+    """Detect and embed the first face of each test image; return (embeddings, labels)."""
+    face_cascade = cv2.CascadeClassifier(HAAR_CASCADE_FILEPATH)
+    crops, labels = [], []
     for img_path, true_name in zip(test_images, true_labels):
         img = cv2.imread(img_path)
         if img is None:
             print(f"Could not read image: {img_path}")
             continue
-        face_cascade = cv2.CascadeClassifier(HAAR_CASCADE_FILEPATH)
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
         faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-        found = False
-        for (x, y, w, h) in faces:
-            face = img[y:y + h, x:x + w]
-            face = cv2.resize(face, (160, 160))
-            emb = embedder.embeddings([face])[0]
-            best_match, best_score = None, 0.0
-            for name, info in data.items():
-                score = cosine_similarity([emb], [info['embedding']])[0][0]
-                if score > best_score:
-                    best_score = score
-                    best_match = name
-            if best_score > 0.5 and best_match == true_name:
-                correct += 1
-            found = True
-            break
-        if not found:
+        if len(faces) == 0:
             print(f"No face found in {img_path}")
-    accuracy = correct / total if total > 0 else 0
+            continue
+        x, y, w, h = faces[0]
+        crops.append(cv2.resize(img[y:y + h, x:x + w], FACE_SIZE))
+        labels.append(true_name)
+    return embed_faces(crops), labels
+
+def score_accuracy(matcher, embeddings, labels, total):
+    """Return the fraction of `total` test images whose face matched its true label."""
+    correct = 0
+    if len(embeddings):
+        for match, true_name in zip(matcher.match(embeddings), labels):
+            if match.score > MATCH_THRESHOLD and match.name == true_name:
+                correct += 1
+    return correct / total if total > 0 else 0
+
+def test_accuracy(test_images, true_labels, section=None, search='exact', pca_dim=None):
+    """Print and return recognition accuracy on labelled test images.
+
+    `pca_dim` evaluates a PCA projection of that many dimensions fitted on
+    the gallery instead of the one stored with it.
+    """
+    if pca_dim:
+        gallery = get_gallery(GALLERY_DIR, EMBEDDINGS_FILE)
+        matcher = GalleryMatcher.from_gallery(gallery, section, fit_pca(gallery.matrix, pca_dim))
+    else:
+        matcher = get_matcher(section, search)
+    embeddings, labels = embed_test_images(test_images, true_labels)
+    accuracy = score_accuracy(matcher, embeddings, labels, len(test_images))
     print(f"Accuracy: {accuracy*100:.2f}%")
     return accuracy
-        
+
+def evaluate_pca_dimensions(test_images, true_labels, dims=(32, 64, 128, 256), section=None, repeat=50):
+    """Report accuracy and matching time of each candidate PCA dimension.
+
+    The test images are embedded once; each dimension is then scored with a
+    projection fitted on the gallery, next to the full 512-d baseline. A
+    gallery with fewer prototype rows than `dim` yields fewer components;
+    the printout shows how many were used.
+    Returns {requested dim: (accuracy, seconds per match call)}.
+    """
+    gallery = get_gallery(GALLERY_DIR, EMBEDDINGS_FILE)
+    embeddings, labels = embed_test_images(test_images, true_labels)
+    results = {}
+    for dim in [None] + list(dims):
+        projection = fit_pca(gallery.matrix, dim) if dim else None
+        matcher = GalleryMatcher.from_gallery(gallery, section, projection)
+        accuracy = score_accuracy(matcher, embeddings, labels, len(test_images))
+        start = time.perf_counter()
+        for _ in range(repeat if len(embeddings) else 0):
+            matcher.match(embeddings)
+        seconds = (time.perf_counter() - start) / max(repeat, 1)
+        realised = matcher.matrix.shape[1]
+        results[dim or EMBEDDING_DIM] = (accuracy, seconds)
+        note = f" (only {realised} fitted)" if dim and realised < dim else ""
+        print(f"[i] {dim or EMBEDDING_DIM:4d} dims{note}: accuracy {accuracy * 100:6.2f}%, "
+              f"{seconds * 1000:.3f} ms per match")
+    return results
+
+def set_gallery_pca(dim):
+    """Fit a PCA of `dim` dimensions on the whole gallery and store it; None removes it.
+
+    Compaction refits it with the same number of components. A gallery
+    with fewer prototype rows than `dim` gets fewer, so run this again
+    once more students are enrolled.
+    """
+    gallery = get_gallery(GALLERY_DIR, EMBEDDINGS_FILE)
+    projection = fit_pca(gallery.matrix, dim) if dim and len(gallery) else None
+    write_projection(projection, GALLERY_DIR)
+    refresh_ann_indexes()
+    if projection is not None:
+        print(f"[✓] Gallery matching now uses {projection[1].shape[0]} PCA dimensions")
+        if projection[1].shape[0] < dim:
+            print(f"[!] Only {projection[1].shape[0]} of {dim} dimensions could be fitted on {len(gallery.matrix)} rows")
+
 def get_registered_students(section=None):
     """Return a list of (name, roll_no, section) for all registered students, optionally filtered by section."""
-    data = load_embeddings()
-    students = []
-    for name, info in data.items():
-        if section is None or info.get('section') == section:
-            students.append((name, info.get('roll_no'), info.get('section')))
-    return students
+    return get_gallery(GALLERY_DIR, EMBEDDINGS_FILE).list_students(section)
         
 def delete_registered_student(name):
     """Delete a registered student by name: remove from embeddings and delete their image directory."""
-    data = load_embeddings()
-    if name in data:
-        del data[name]
-        save_embeddings(data)
+    if name in get_gallery(GALLERY_DIR, EMBEDDINGS_FILE):
+        append_journal({name: None}, GALLERY_DIR)
+        refresh_ann_indexes()
+        maybe_compact(GALLERY_DIR)
     # Remove student images directory if exists
     student_dir = os.path.join(IMAGES_DIR, name)
     if os.path.exists(student_dir):
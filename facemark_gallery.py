@@ -0,0 +1,689 @@
+# facemark_gallery.py
+
+import json
+import os
+import pickle
+import shutil
+import struct
+import threading
+import time
+import numpy as np
+from bisect import bisect_left
+from contextlib import contextmanager
+from facemark_index import spherical_kmeans
+
+GALLERY_DIR = "gallery"
+MATRIX_FILE = "embeddings.npy"
+META_FILE = "students.json"
+QUANTIZED_FILES = {'float16': "embeddings_f16.npy", 'int8': "embeddings_i8.npy"}
+SCALES_FILE = "scales.npy"
+PCA_FILE = "pca.npz"
+JOURNAL_FILE = "journal.log"
+SNAPSHOTS_DIR = "snapshots"
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "gallery.lock"
+SNAPSHOT_KEEP = 3  # snapshots kept for readers still pinned to older versions
+JOURNAL_COMPACT_MIN_BYTES = 1 << 20
+JOURNAL_COMPACT_FRACTION = 0.25  # of the snapshot matrix size
+JOURNAL_COMPACT_RECORDS = 64  # replaying more than this on every reload costs more than a rewrite
+JOURNAL_COMPACT_AGE = 3600.0  # seconds a snapshot's journal may keep growing
+QUANTIZATIONS = ('float32', 'float16', 'int8')
+LEGACY_EMBEDDINGS_FILE = "embeddings.pkl"
+EMBEDDING_DIM = 512
+MAX_PROTOTYPES = 5  # samples per student kept as-is; more are summarized by k-means centroids
+
+def l2_normalize(vectors):
+    """Return float32 copies of the rows of `vectors` scaled to unit length."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def quantize(matrix, quantization):
+    """Return (quantized, scales) copies of `matrix`; scales is None except for int8.
+
+    int8 rows are scaled individually so that their largest component maps
+    to 127; a row is recovered as quantized * scale.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if quantization == 'float16':
+        return matrix.astype(np.float16), None
+    if quantization == 'int8':
+        scales = np.abs(matrix).max(axis=1) / 127.0 if len(matrix) else np.zeros(0, np.float32)
+        scales = np.where(scales == 0, 1.0, scales).astype(np.float32)
+        return np.round(matrix / scales[:, None]).astype(np.int8), scales
+    raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+
+def make_prototypes(samples, max_prototypes=MAX_PROTOTYPES):
+    """Return the normalized prototype rows kept for one student's embedding samples.
+
+    Up to `max_prototypes` samples are kept as they are, which preserves
+    pose variety; larger sets are reduced to that many k-means centroids.
+    """
+    samples = l2_normalize(np.atleast_2d(samples))
+    if len(samples) <= max_prototypes:
+        return samples
+    return l2_normalize(spherical_kmeans(samples, max_prototypes))
+
+def fit_pca(matrix, dim):
+    """Fit a PCA projection to `dim` dimensions on the rows of `matrix`; return (mean, components).
+
+    At most as many components as there are rows can be learned.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    mean = matrix.mean(axis=0)
+    _, _, vt = np.linalg.svd(matrix - mean, full_matrices=False)
+    return mean.astype(np.float32), np.ascontiguousarray(vt[:min(dim, len(vt))], dtype=np.float32)
+
+def project(vectors, projection):
+    """Project embeddings with a (mean, components) PCA and re-normalize them."""
+    mean, components = projection
+    return l2_normalize((np.asarray(vectors, dtype=np.float32) - mean) @ components.T)
+
+def write_projection(projection, gallery_dir=GALLERY_DIR):
+    """Publish a new snapshot of the latest gallery with a PCA projection, or without one for None.
+
+    The projection is part of the snapshot, so a pinned reader keeps the
+    projection it was opened with.
+    """
+    with gallery_lock(gallery_dir):
+        gallery = _read_latest(gallery_dir)
+        gallery.projection = projection
+        _write_snapshot(gallery, gallery_dir)
+
+def _read_projection(directory, gallery_dir):
+    # Snapshots written before projections were versioned rely on gallery/pca.npz
+    for path in (os.path.join(directory, PCA_FILE), os.path.join(gallery_dir, PCA_FILE)):
+        if os.path.exists(path):
+            with np.load(path) as pca:
+                return pca['mean'], pca['components']
+    return None
+
+def _section_key(section):
+    return "" if section is None else str(section)
+
+class Gallery:
+    """Registered students as one embedding matrix plus a small metadata table.
+
+    Each student owns one or more L2-normalized prototype rows of `matrix`:
+    `students[i]` has rows `offsets[i]:offsets[i + 1]`. Students are sorted
+    by section, so each section is the contiguous block of students
+    `section_ranges[section]` (and of rows `row_range(section)`). Loaded
+    from disk, `matrix` is a read-only memory map and only the rows actually
+    used are paged in.
+
+    A gallery written with float16 or int8 `quantization` also carries a
+    compact copy of the matrix (`quantized`, plus per-row `scales` for
+    int8) that matching scans instead of the float32 rows. `projection` is
+    the (mean, components) PCA stored with the gallery, if any.
+    """
+
+    def __init__(self, matrix, students, section_ranges=None, quantization='float32', quantized=None, scales=None,
+                 offsets=None):
+        self.matrix = matrix
+        self.offsets = np.arange(len(students) + 1) if offsets is None else np.asarray(offsets)
+        self.quantization = quantization
+        self.quantized = quantized
+        self.scales = scales
+        self.projection = None
+        self.pin = None  # (snapshot version, journal offset) this gallery was read from
+        self.students = students
+        self.rows = {student['name']: i for i, student in enumerate(students)}
+        if section_ranges is None:
+            section_ranges = {}
+            for i, student in enumerate(students):
+                key = _section_key(student['section'])
+                start, _ = section_ranges.get(key, (i, i))
+                section_ranges[key] = (start, i + 1)
+        self.section_ranges = section_ranges
+        self._derived = {}
+
+    def cached(self, key, factory):
+        """Return `factory()` computed once per gallery version under `key`.
+
+        Used for per-section views and matchers, which stay valid until the
+        gallery is reloaded.
+        """
+        if key not in self._derived:
+            self._derived[key] = factory()
+        return self._derived[key]
+
+    def __len__(self):
+        return len(self.students)
+
+    def __contains__(self, name):
+        return name in self.rows
+
+    def section_range(self, section=None):
+        """Return the (start, end) students of `section`, or of the whole gallery for None."""
+        if section is None:
+            return 0, len(self.students)
+        return self.section_ranges.get(_section_key(section), (0, 0))
+
+    def row_range(self, section=None):
+        """Return the (start, end) matrix rows of `section`, or of the whole gallery for None."""
+        start, end = self.section_range(section)
+        return int(self.offsets[start]), int(self.offsets[end])
+
+    def prototypes(self, name):
+        """Return the prototype rows of a registered student."""
+        i = self.rows[name]
+        return self.matrix[self.offsets[i]:self.offsets[i + 1]]
+
+    def info(self, name):
+        """Return {'roll_no', 'section'} for a registered student."""
+        student = self.students[self.rows[name]]
+        return {'roll_no': student['roll_no'], 'section': student['section']}
+
+    def list_students(self, section=None):
+        """Return (name, roll_no, section) for the students of `section` (all for None)."""
+        def build():
+            start, end = self.section_range(section)
+            return [(s['name'], s['roll_no'], s['section']) for s in self.students[start:end]]
+        return list(self.cached(('students', _section_key(section) if section is not None else None), build))
+
+    def to_dict(self):
+        """Return the gallery in the legacy {name: {'embedding', 'roll_no', 'section'}} form.
+
+        'embedding' is a single row, or a (prototypes, dim) array for
+        students with several prototypes.
+        """
+        data = {}
+        for i, s in enumerate(self.students):
+            rows = self.matrix[self.offsets[i]:self.offsets[i + 1]]
+            data[s['name']] = {'embedding': rows[0] if len(rows) == 1 else rows,
+                               'roll_no': s['roll_no'], 'section': s['section']}
+        return data
+
+def _student_key(student):
+    return _section_key(student['section']), student['name']
+
+def build_gallery(data):
+    """Build an in-memory Gallery from a {name: {'embedding', 'roll_no', 'section'}} dict.
+
+    An 'embedding' may hold several prototype rows.
+    """
+    names = sorted(data, key=lambda name: (_section_key(data[name].get('section')), name))
+    students = [
+        {'name': name, 'roll_no': data[name].get('roll_no'), 'section': data[name].get('section')}
+        for name in names
+    ]
+    blocks = [np.asarray(data[name]['embedding'], dtype=np.float32).reshape(-1, EMBEDDING_DIM) for name in names]
+    if names:
+        matrix = l2_normalize(np.concatenate(blocks))
+    else:
+        matrix = np.zeros((0, EMBEDDING_DIM), dtype=np.float32)
+    offsets = np.concatenate([[0], np.cumsum([len(block) for block in blocks], dtype=np.int64)])
+    return Gallery(np.ascontiguousarray(matrix), students, offsets=offsets)
+
+def apply_changes(gallery, changes):
+    """Return a copy of `gallery` with per-student changes applied in one pass.
+
+    `changes` maps a name to None (delete) or to a {'prototypes', 'roll_no',
+    'section'} record; a None roll_no or section keeps the student's current
+    one. Rows of unchanged students are gathered with a single copy and the
+    new rows, sorted once, are merged in between them.
+    """
+    kept = [i for i, student in enumerate(gallery.students) if student['name'] not in changes]
+    kept_keys = [_student_key(gallery.students[i]) for i in kept]
+    added = []
+    for name, record in changes.items():
+        if record is None:
+            continue
+        roll_no, section = record.get('roll_no'), record.get('section')
+        if name in gallery:
+            old = gallery.students[gallery.rows[name]]
+            roll_no = old['roll_no'] if roll_no is None else roll_no
+            section = old['section'] if section is None else section
+        student = {'name': name, 'roll_no': roll_no, 'section': section}
+        added.append((_student_key(student), student, l2_normalize(np.atleast_2d(record['prototypes']))))
+    added.sort(key=lambda entry: entry[0])
+
+    kept_counts = np.diff(gallery.offsets)[kept]
+    kept_offsets = np.concatenate([[0], np.cumsum(kept_counts, dtype=np.int64)])
+    rows = np.repeat(gallery.offsets[kept] - kept_offsets[:-1], kept_counts) + np.arange(kept_offsets[-1])
+    kept_matrix = np.asarray(gallery.matrix[rows], dtype=np.float32)
+    students, blocks, counts, start = [], [], [], 0
+    for key, student, block in added + [(None, None, None)]:
+        stop = len(kept) if key is None else bisect_left(kept_keys, key, start)
+        students.extend(gallery.students[i] for i in kept[start:stop])
+        blocks.append(kept_matrix[kept_offsets[start]:kept_offsets[stop]])
+        counts.append(kept_counts[start:stop])
+        if student is not None:
+            students.append(student)
+            blocks.append(block)
+            counts.append([len(block)])
+        start = stop
+    dim = gallery.matrix.shape[1] if len(gallery.matrix) else EMBEDDING_DIM
+    matrix = np.concatenate(blocks) if students else np.zeros((0, dim), dtype=np.float32)
+    offsets = np.concatenate([[0], np.cumsum(np.concatenate(counts), dtype=np.int64)])
+    new = Gallery(np.ascontiguousarray(matrix, dtype=np.float32), students, quantization=gallery.quantization,
+                  offsets=offsets)
+    if gallery.quantization != 'float32':
+        new.quantized, new.scales = quantize(new.matrix, gallery.quantization)
+    new.projection = gallery.projection
+    return new
+
+# On disk the gallery is a series of immutable snapshots, gallery/snapshots/vN/,
+# each holding the matrix files, the metadata table, the PCA projection if any
+# and the journal of changes made since. gallery/CURRENT names the latest one
+# and is swapped atomically.
+# Writers serialize on an advisory file lock; readers take no lock and keep
+# using the snapshot they opened (see Gallery.pin) while newer ones appear.
+# Galleries written before versioning keep their files directly in gallery/
+# and are read as version None until the next write.
+
+@contextmanager
+def gallery_lock(gallery_dir=GALLERY_DIR):
+    """Hold the gallery's advisory write lock, shared by every process using it."""
+    os.makedirs(gallery_dir, exist_ok=True)
+    with open(os.path.join(gallery_dir, LOCK_FILE), 'a+b') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after ~10s; keep waiting
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def current_version(gallery_dir=GALLERY_DIR):
+    """Return the number of the latest snapshot, or None for an unversioned gallery."""
+    try:
+        with open(os.path.join(gallery_dir, CURRENT_FILE)) as f:
+            return int(f.read().strip().lstrip('v'))
+    except FileNotFoundError:
+        return None
+
+def snapshot_dir(gallery_dir=GALLERY_DIR, version=None):
+    if version is None:
+        return gallery_dir
+    return os.path.join(gallery_dir, SNAPSHOTS_DIR, f"v{version}")
+
+def _read_meta(directory):
+    with open(os.path.join(directory, META_FILE)) as f:
+        return json.load(f)
+
+def _snapshot_versions(gallery_dir):
+    try:
+        entries = os.listdir(os.path.join(gallery_dir, SNAPSHOTS_DIR))
+    except FileNotFoundError:
+        return []
+    return sorted(int(entry[1:]) for entry in entries if entry.startswith('v') and entry[1:].isdigit())
+
+def _write_snapshot(gallery, gallery_dir, quantization=None):
+    # Caller holds gallery_lock
+    version = current_version(gallery_dir)
+    if quantization is None:
+        quantization = gallery.quantization
+        if quantization == 'float32' and gallery_exists(gallery_dir):
+            quantization = _read_meta(snapshot_dir(gallery_dir, version)).get('quantization', 'float32')
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization {quantization!r}, expected one of {QUANTIZATIONS}")
+    matrix = np.asarray(gallery.matrix, dtype=np.float32)
+    arrays = {MATRIX_FILE: matrix}
+    if quantization != 'float32':
+        quantized, scales = quantize(matrix, quantization)
+        arrays[QUANTIZED_FILES[quantization]] = quantized
+        if scales is not None:
+            arrays[SCALES_FILE] = scales
+    meta = {
+        'dim': int(matrix.shape[1]),
+        'quantization': quantization,
+        'students': [dict(student, row=i, prototypes=int(gallery.offsets[i + 1] - gallery.offsets[i]))
+                     for i, student in enumerate(gallery.students)],
+        'sections': {key: list(rows) for key, rows in gallery.section_ranges.items()},
+    }
+    # Build the new snapshot under a temporary name, then publish it with two renames
+    new_version = max(_snapshot_versions(gallery_dir) + [version or 0]) + 1
+    target = snapshot_dir(gallery_dir, new_version)
+    staging = os.path.join(gallery_dir, SNAPSHOTS_DIR, f".v{new_version}.tmp")
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    for name, array in arrays.items():
+        with open(os.path.join(staging, name), 'wb') as f:
+            np.save(f, array)
+    if gallery.projection is not None:
+        with open(os.path.join(staging, PCA_FILE), 'wb') as f:
+            np.savez(f, mean=gallery.projection[0], components=gallery.projection[1])
+    with open(os.path.join(staging, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    os.replace(staging, target)
+    current_path = os.path.join(gallery_dir, CURRENT_FILE)
+    with open(current_path + ".tmp", 'w') as f:
+        f.write(f"v{new_version}\n")
+    os.replace(current_path + ".tmp", current_path)
+    invalidate_gallery_cache(gallery_dir)
+    _prune_snapshots(gallery_dir, new_version)
+
+def _prune_snapshots(gallery_dir, latest):
+    # Readers pinned to an older snapshot keep their open memory maps on POSIX;
+    # on Windows a mapped snapshot cannot be removed yet and is retried next time
+    for version in _snapshot_versions(gallery_dir):
+        if version <= latest - SNAPSHOT_KEEP:
+            shutil.rmtree(snapshot_dir(gallery_dir, version), ignore_errors=True)
+    for name in [META_FILE, MATRIX_FILE, SCALES_FILE, JOURNAL_FILE, PCA_FILE] + list(QUANTIZED_FILES.values()):
+        path = os.path.join(gallery_dir, name)
+        if os.path.exists(path):
+            try:
+                os.remove(path)  # leftovers of the unversioned layout
+            except OSError:
+                pass
+
+def _read_latest(gallery_dir, legacy_pickle=None):
+    # Caller holds gallery_lock; returns an in-memory copy of the latest gallery
+    if not gallery_exists(gallery_dir) and legacy_pickle and os.path.exists(legacy_pickle):
+        with open(legacy_pickle, 'rb') as f:
+            data = pickle.load(f)
+        print(f"[i] Migrating {len(data)} students from {legacy_pickle} to {gallery_dir}/")
+        return apply_changes(build_gallery(data), read_journal(gallery_dir)[0])
+    return read_gallery(gallery_dir, mmap=False)
+
+def write_gallery(gallery, gallery_dir=GALLERY_DIR, quantization=None):
+    """Publish `gallery` as a new snapshot: an .npy matrix plus a JSON metadata table.
+
+    `quantization` ('float32', 'float16' or 'int8') also stores a compact
+    copy of the matrix for matching; None keeps the gallery's current setting.
+    Likewise the current PCA projection is kept unless `gallery` has its own.
+    The new snapshot starts with an empty journal.
+    """
+    with gallery_lock(gallery_dir):
+        if gallery.projection is None and gallery_exists(gallery_dir):
+            version = current_version(gallery_dir)
+            gallery.projection = _read_projection(snapshot_dir(gallery_dir, version), gallery_dir)
+        _write_snapshot(gallery, gallery_dir, quantization)
+
+def rewrite_gallery(gallery_dir=GALLERY_DIR, quantization=None, legacy_pickle=LEGACY_EMBEDDINGS_FILE, update=None):
+    """Fold the latest gallery and its journal into a new snapshot, under the write lock.
+
+    `update`, if given, is called with the latest gallery and returns
+    changes for apply_changes, which go into the same snapshot. A PCA
+    projection is refitted on the new matrix with as many components as
+    before, so students enrolled since it was fitted are covered.
+    """
+    with gallery_lock(gallery_dir):
+        gallery = _read_latest(gallery_dir, legacy_pickle)
+        if update is not None:
+            gallery = apply_changes(gallery, update(gallery))
+        if gallery.projection is not None and len(gallery.matrix):
+            gallery.projection = fit_pca(gallery.matrix, len(gallery.projection[1]))
+        _write_snapshot(gallery, gallery_dir, quantization)
+
+def read_gallery(gallery_dir=GALLERY_DIR, mmap=True, pin=None):
+    """Open the latest snapshot, or the one `pin` (see Gallery.pin) refers to.
+
+    The snapshot's matrices are memory-mapped. Changes recorded in its
+    journal are replayed on top; the result then holds an in-memory copy
+    until the next compaction. A gallery that was never written reads as
+    empty (plus any journalled changes).
+    """
+    for attempt in range(3):
+        version = pin[0] if pin else current_version(gallery_dir)
+        try:
+            return _read_snapshot(gallery_dir, version, mmap, pin[1] if pin else None)
+        except FileNotFoundError:
+            # The snapshot was pruned between reading CURRENT and opening it
+            if pin or attempt == 2:
+                raise
+
+def _read_snapshot(gallery_dir, version, mmap, journal_limit):
+    directory = snapshot_dir(gallery_dir, version)
+    if version is None and not os.path.exists(os.path.join(directory, META_FILE)):
+        gallery = build_gallery({})
+    else:
+        meta = _read_meta(directory)
+        mmap_mode = 'r' if mmap else None
+        matrix = np.load(os.path.join(directory, MATRIX_FILE), mmap_mode=mmap_mode)
+        quantization = meta.get('quantization', 'float32')
+        quantized = scales = None
+        if quantization != 'float32':
+            quantized = np.load(os.path.join(directory, QUANTIZED_FILES[quantization]), mmap_mode=mmap_mode)
+            if quantization == 'int8':
+                scales = np.load(os.path.join(directory, SCALES_FILE), mmap_mode=mmap_mode)
+        ordered = sorted(meta['students'], key=lambda s: s['row'])
+        students = [{'name': s['name'], 'roll_no': s['roll_no'], 'section': s['section']} for s in ordered]
+        # Galleries written before multi-prototype support hold one row per student
+        offsets = np.concatenate([[0], np.cumsum([s.get('prototypes', 1) for s in ordered], dtype=np.int64)])
+        section_ranges = {key: tuple(rows) for key, rows in meta['sections'].items()}
+        gallery = Gallery(matrix, students, section_ranges, quantization, quantized, scales, offsets)
+    gallery.projection = _read_projection(directory, gallery_dir)
+    changes, offset = read_journal(directory, journal_limit)
+    if changes:
+        gallery = apply_changes(gallery, changes)
+    gallery.pin = (version, offset)
+    return gallery
+
+# Single-student changes are appended to the current snapshot's journal
+# instead of writing a new snapshot. Each record is a length-prefixed pickle
+# of (name, record-or-None).
+_RECORD_HEADER = struct.Struct('<Q')
+
+def _journal_end(f):
+    # Offset just past the last complete record; anything after it is a torn append
+    size = f.seek(0, os.SEEK_END)
+    offset = 0
+    while offset + _RECORD_HEADER.size <= size:
+        f.seek(offset)
+        (length,) = _RECORD_HEADER.unpack(f.read(_RECORD_HEADER.size))
+        if offset + _RECORD_HEADER.size + length > size:
+            break
+        offset += _RECORD_HEADER.size + length
+    return offset
+
+def append_journal(changes, gallery_dir=GALLERY_DIR):
+    """Append {name: record or None} changes to the gallery journal.
+
+    A record is {'prototypes', 'roll_no', 'section'}; None deletes the student.
+    """
+    with gallery_lock(gallery_dir):
+        directory = snapshot_dir(gallery_dir, current_version(gallery_dir))
+        with open(os.path.join(directory, JOURNAL_FILE), 'a+b') as f:
+            end = _journal_end(f)
+            if end != f.seek(0, os.SEEK_END):
+                f.truncate(end)  # drop a torn record so the new ones stay readable
+            for name, record in changes.items():
+                if record is not None:
+                    record = dict(record, prototypes=np.asarray(record['prototypes'], dtype=np.float32))
+                payload = pickle.dumps((name, record), protocol=pickle.HIGHEST_PROTOCOL)
+                f.write(_RECORD_HEADER.pack(len(payload)) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+    invalidate_gallery_cache(gallery_dir)
+
+def read_journal(directory, limit=None):
+    """Return ({name: net change}, end offset of the last complete record) for a snapshot's journal.
+
+    Records past byte offset `limit` are ignored. Several records for one
+    student collapse into the latest, which inherits a roll_no or section
+    it left as None from the earlier ones.
+    """
+    changes = {}
+    offset = 0
+    try:
+        f = open(os.path.join(directory, JOURNAL_FILE), 'rb')
+    except FileNotFoundError:
+        return changes, offset
+    with f:
+        while limit is None or offset < limit:
+            header = f.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                break
+            (length,) = _RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break  # torn final record from an interrupted append
+            name, record = pickle.loads(payload)
+            previous = changes.pop(name, None)  # re-insert to keep the order of the latest changes
+            if record is not None and previous is not None:
+                record = dict(record,
+                              roll_no=previous['roll_no'] if record.get('roll_no') is None else record['roll_no'],
+                              section=previous['section'] if record.get('section') is None else record['section'])
+            changes[name] = record
+            offset = f.tell()
+    return changes, offset
+
+def journal_size(gallery_dir=GALLERY_DIR):
+    """Return the size in bytes of the latest snapshot's journal."""
+    try:
+        return os.path.getsize(os.path.join(snapshot_dir(gallery_dir, current_version(gallery_dir)), JOURNAL_FILE))
+    except FileNotFoundError:
+        return 0
+
+def journal_records(gallery_dir=GALLERY_DIR):
+    """Return the number of complete records in the latest snapshot's journal."""
+    try:
+        f = open(os.path.join(snapshot_dir(gallery_dir, current_version(gallery_dir)), JOURNAL_FILE), 'rb')
+    except FileNotFoundError:
+        return 0
+    with f:
+        size = f.seek(0, os.SEEK_END)
+        offset = count = 0
+        while offset + _RECORD_HEADER.size <= size:
+            f.seek(offset)
+            (length,) = _RECORD_HEADER.unpack(f.read(_RECORD_HEADER.size))
+            offset += _RECORD_HEADER.size + length
+            if offset > size:
+                break
+            count += 1
+    return count
+
+_compaction_lock = threading.Lock()
+
+def compact_gallery(gallery_dir=GALLERY_DIR, legacy_pickle=LEGACY_EMBEDDINGS_FILE):
+    """Fold the journal into a new snapshot; return False if another compaction is running."""
+    if not _compaction_lock.acquire(blocking=False):
+        return False
+    try:
+        if journal_size(gallery_dir):
+            rewrite_gallery(gallery_dir, legacy_pickle=legacy_pickle)
+        return True
+    finally:
+        _compaction_lock.release()
+
+def maybe_compact(gallery_dir=GALLERY_DIR, background=True):
+    """Compact the gallery once its journal has grown large, long or old.
+
+    Due when the journal reaches JOURNAL_COMPACT_FRACTION of the snapshot
+    (and JOURNAL_COMPACT_MIN_BYTES), holds JOURNAL_COMPACT_RECORDS records,
+    or its snapshot is older than JOURNAL_COMPACT_AGE seconds. Every reload
+    replays the journal into an in-memory copy of the matrix, so even a
+    small journal is not left in place for long; get_gallery checks this
+    whenever it loads a gallery with a journal. With `background` the
+    compaction runs in a daemon thread, which is returned; otherwise it runs
+    inline. Returns None if nothing was due.
+    """
+    size = journal_size(gallery_dir)
+    if not size:
+        return None
+    directory = snapshot_dir(gallery_dir, current_version(gallery_dir))
+    try:
+        snapshot = os.path.getsize(os.path.join(directory, MATRIX_FILE))
+        age = time.time() - os.path.getmtime(os.path.join(directory, META_FILE))
+    except FileNotFoundError:
+        snapshot, age = 0, 0.0
+    large = size >= JOURNAL_COMPACT_MIN_BYTES and size >= JOURNAL_COMPACT_FRACTION * snapshot
+    if not (large or age >= JOURNAL_COMPACT_AGE or journal_records(gallery_dir) >= JOURNAL_COMPACT_RECORDS):
+        return None
+    if not background:
+        compact_gallery(gallery_dir)
+        return None
+    thread = threading.Thread(target=compact_gallery, args=(gallery_dir,), name="gallery-compaction", daemon=True)
+    thread.start()
+    return thread
+
+def migrate_pickle(pickle_path=LEGACY_EMBEDDINGS_FILE, gallery_dir=GALLERY_DIR):
+    """Convert a legacy embeddings.pkl into the gallery format; the pickle is left in place."""
+    with gallery_lock(gallery_dir):
+        if not gallery_exists(gallery_dir):
+            _write_snapshot(_read_latest(gallery_dir, pickle_path), gallery_dir)
+
+def gallery_exists(gallery_dir=GALLERY_DIR):
+    """Return True once a snapshot has been written."""
+    return (os.path.exists(os.path.join(gallery_dir, CURRENT_FILE))
+            or os.path.exists(os.path.join(gallery_dir, META_FILE)))
+
+def load_gallery(gallery_dir=GALLERY_DIR, legacy_pickle=LEGACY_EMBEDDINGS_FILE, pin=None):
+    """Open the gallery, migrating a legacy pickle on first use."""
+    if not gallery_exists(gallery_dir) and legacy_pickle and os.path.exists(legacy_pickle):
+        migrate_pickle(legacy_pickle, gallery_dir)
+    return read_gallery(gallery_dir, pin=pin)
+
+# Process-wide cache of loaded galleries. The latest gallery of a directory is
+# reused while CURRENT and its journal are unchanged and no write has been
+# made from this process since it was loaded. Pinned snapshots never change,
+# so they are kept as long as they are among the most recent.
+# The lock is re-entrant because loading may migrate a legacy pickle, which
+# invalidates the cache.
+_gallery_cache = {}
+_pinned_cache = {}
+_gallery_cache_lock = threading.RLock()
+_gallery_version = 0
+PINNED_CACHE_SIZE = 4
+
+def _file_signature(gallery_dir):
+    version = current_version(gallery_dir)
+    signature = [version]
+    for path in (os.path.join(snapshot_dir(gallery_dir, version), JOURNAL_FILE),
+                 os.path.join(gallery_dir, META_FILE), os.path.join(gallery_dir, PCA_FILE)):
+        try:
+            st = os.stat(path)
+            signature.append((st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+def invalidate_gallery_cache(gallery_dir=None):
+    """Forget the cached latest gallery of `gallery_dir`, or of every directory for None."""
+    global _gallery_version
+    with _gallery_cache_lock:
+        _gallery_version += 1
+        if gallery_dir is None:
+            _gallery_cache.clear()
+        else:
+            _gallery_cache.pop(os.path.abspath(gallery_dir), None)
+
+def get_gallery(gallery_dir=GALLERY_DIR, legacy_pickle=LEGACY_EMBEDDINGS_FILE, pin=None):
+    """Return the shared Gallery, reloading it only when its files changed.
+
+    With `pin` (a Gallery.pin from any process) the same snapshot and
+    journal prefix are returned; if that snapshot has been pruned, the
+    latest gallery is used instead.
+    """
+    path = os.path.abspath(gallery_dir)
+    with _gallery_cache_lock:
+        if pin is not None:
+            latest = _gallery_cache.get(path)
+            if latest is not None and latest[1].pin == tuple(pin):
+                return latest[1]
+            key = (path, tuple(pin))
+            if key not in _pinned_cache:
+                try:
+                    _pinned_cache[key] = read_gallery(gallery_dir, pin=tuple(pin))
+                except FileNotFoundError:
+                    print(f"[!] Gallery snapshot v{pin[0]} is no longer available, using the latest")
+                    return get_gallery(gallery_dir, legacy_pickle)
+                while len(_pinned_cache) > PINNED_CACHE_SIZE:
+                    _pinned_cache.pop(next(iter(_pinned_cache)))
+            return _pinned_cache[key]
+        entry = _gallery_cache.get(path)
+        if entry is not None and entry[0] == (_gallery_version, _file_signature(gallery_dir)):
+            return entry[1]
+        gallery = load_gallery(gallery_dir, legacy_pickle)
+        _gallery_cache[path] = ((_gallery_version, _file_signature(gallery_dir)), gallery)
+    if gallery.pin[1]:
+        # Readers check too, so the journal left by the last write does not
+        # have to be replayed by every later load
+        maybe_compact(gallery_dir)
+    return gallery
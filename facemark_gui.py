@@ -1,15 +1,21 @@
 # facemark_gui.py
+import time
+_START_TIME = time.perf_counter()
+
 import customtkinter as ctk
 from tkinter import messagebox, filedialog
 import tkinter as tk
-from PIL import Image, ImageTk
-import cv2
 from datetime import datetime
 import os
-import pandas as pd
-from facemark_core import register_student, mark_attendance_from_video, ensure_dirs, get_registered_students, delete_registered_student
+import queue
+import subprocess
+import sys
+import threading
 import traceback
 
+# Heavy modules (facemark_core with OpenCV/TensorFlow, pandas, PIL) are
+# imported inside the pages that use them so the login window opens fast.
+
 # Session context to store faculty info
 session = {
     'faculty_name': '',
@@ -49,8 +55,40 @@ def show_error(title, message):
     error_msg = f"{message}\n\nTraceback:\n{traceback.format_exc()}"
     messagebox.showerror(title, error_msg)
 
+def start_background_warmup():
+    """Import the recognition core and warm up FaceNet without blocking the UI"""
+    def warm_up():
+        import facemark_core
+        facemark_core.warm_up_embedder(background=False)
+    threading.Thread(target=warm_up, name="facemark-warmup", daemon=True).start()
+
+def import_time_report(module="facemark_gui", top=15):
+    """Return the `top` slowest imports of `module` from a `python -X importtime` run"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line[len("import time:"):].split("|")]
+        rows.append((int(cumulative_us), int(self_us), name))
+    rows.sort(reverse=True)
+    return rows[:top]
+
+def print_startup_report(first_window_seconds):
+    """Print time-to-first-window and the slowest imports of the GUI"""
+    print(f"[i] Time to first window: {first_window_seconds * 1000:.0f} ms")
+    print("[i] Slowest imports (cumulative / self, ms):")
+    for cumulative_us, self_us, name in import_time_report():
+        print(f"    {cumulative_us / 1000:8.1f} {self_us / 1000:8.1f}  {name}")
+
+# Set by `--startup-report` or FACEMARK_STARTUP_REPORT=1
+STARTUP_REPORT = "--startup-report" in sys.argv or os.environ.get("FACEMARK_STARTUP_REPORT") == "1"
+
 class LoadingOverlay(ctk.CTkFrame):
-    def __init__(self, parent, **kwargs):
+    def __init__(self, parent, on_cancel=None, **kwargs):
         super().__init__(parent, **kwargs)
         self.configure(fg_color=VIBRANT_BG, corner_radius=10)
         
@@ -69,6 +107,20 @@ class LoadingOverlay(ctk.CTkFrame):
         self.progress = ctk.CTkProgressBar(self)
         self.progress.pack(pady=10)
         self.progress.set(0)
+
+        self.detail = ctk.CTkLabel(
+            self,
+            text="",
+            font=("Arial", 12),
+            text_color=VIBRANT_DARK
+        )
+        self.detail.pack(padx=20, pady=(0, 10))
+
+        # Optional cancel button for long-running work
+        self.cancel_button = None
+        if on_cancel is not None:
+            self.cancel_button = ctk.CTkButton(self, text="Cancel", command=on_cancel, width=100)
+            self.cancel_button.pack(pady=(0, 20))
         
         # Hide initially
         self.place_forget()
@@ -80,6 +132,12 @@ class LoadingOverlay(ctk.CTkFrame):
     def hide(self):
         self.place_forget()
 
+    def update_progress(self, fraction, text=None):
+        """Set the bar to `fraction` (0-1) and optionally the detail line below it."""
+        self.progress.set(max(0.0, min(1.0, fraction)))
+        if text is not None:
+            self.detail.configure(text=text)
+
 class ModernButton(ctk.CTkButton):
     def __init__(self, master, **kwargs):
         # Remove fg_color from kwargs if it exists to avoid duplicate
@@ -263,11 +321,18 @@ def show_login():
             corner_radius=1
         ).pack(fill="x", pady=(0, 20))
 
+        if STARTUP_REPORT:
+            login_win.after(0, lambda: print_startup_report(time.perf_counter() - _START_TIME))
+
+        # Load FaceNet in the background while the faculty member logs in
+        login_win.after(100, start_background_warmup)
+
         login_win.mainloop()
     except Exception as e:
         show_error("Application Error", str(e))
 
 def open_home():
+    from facemark_core import ensure_dirs
     ensure_dirs()
     app = ctk.CTk()
     app.title("FaceMark Dashboard")
@@ -428,6 +493,9 @@ def open_home():
     app.mainloop()
 
 def show_register_page(frame):
+    from facemark_core import (register_student, detect_face_crop, embed_faces, update_student_prototypes,
+                               get_registered_students)
+
     # Create main container with padding
     container = ctk.CTkFrame(frame, fg_color="transparent")
     container.pack(fill="both", expand=True, padx=40, pady=40)
@@ -573,6 +641,8 @@ def show_register_page(frame):
         )
         
         if file_path:
+            import cv2
+            from PIL import Image, ImageTk
             try:
                 # Read and process the image
                 img = cv2.imread(file_path)
@@ -603,8 +673,38 @@ def show_register_page(frame):
                 # Save the image
                 save_path = os.path.join("student_images", f"{roll_var.get()}_{name_var.get()}.jpg")
                 cv2.imwrite(save_path, img)
-                
-                messagebox.showinfo("Success", "Student photo uploaded successfully!")
+
+                # Enroll the face on a worker thread, keeping any samples captured earlier
+                name, roll_no, section = name_var.get(), roll_var.get(), session['current_section']
+                result = {}
+
+                def enroll():
+                    try:
+                        face = detect_face_crop(save_path)
+                        if face is not None:
+                            update_student_prototypes(name, embed_faces([face]), roll_no, section, merge=True)
+                        result['found'] = face is not None
+                    except Exception as e:
+                        result['error'] = str(e)
+
+                def poll():
+                    if not upload_btn.winfo_exists():
+                        return
+                    if not result:
+                        upload_btn.after(100, poll)
+                        return
+                    upload_btn.configure(state="normal")
+                    if 'error' in result:
+                        messagebox.showerror("Error", f"Failed to process image: {result['error']}")
+                    elif not result['found']:
+                        messagebox.showwarning("No Face", "No face was found in the photo. Please choose a clearer picture.")
+                    else:
+                        messagebox.showinfo("Success", "Student photo uploaded and registered successfully!")
+                        refresh_students_list()
+
+                upload_btn.configure(state="disabled")
+                threading.Thread(target=enroll, name="facemark-enroll", daemon=True).start()
+                upload_btn.after(100, poll)
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to process image: {str(e)}")
 
@@ -638,6 +738,8 @@ def show_register_page(frame):
     upload_btn.pack(side="right", fill="x", expand=True, padx=(5, 0))
 
 def show_attendance_upload(frame):
+    from facemark_core import iter_attendance_events
+
     container = ctk.CTkFrame(frame, fg_color="transparent")
     container.pack(fill="both", expand=True, padx=40, pady=40)
 
@@ -689,28 +791,98 @@ def show_attendance_upload(frame):
         if file:
             path_var.set(file)
 
+    running = {'cancel': None}
+
     def process():
         if not path_var.get():
             messagebox.showwarning("Error", "No video file selected")
             return
+        if running['cancel'] is not None:
+            messagebox.showinfo("Busy", "A video is already being processed.")
+            return
 
-        # Show loading overlay
-        loading = LoadingOverlay(frame)
+        # Processing runs on a worker thread; its events are polled from the Tk loop
+        cancel = threading.Event()
+        events = queue.Queue()
+        running['cancel'] = cancel
+        found = []
+        started = time.perf_counter()
+
+        def request_cancel():
+            cancel.set()
+            loading.update_progress(loading.progress.get(), "Cancelling...")
+            if loading.cancel_button is not None:
+                loading.cancel_button.configure(state="disabled")
+
+        loading = LoadingOverlay(frame, on_cancel=request_cancel)
+        loading.label.configure(text="Processing video...")
         loading.show()
-        frame.update()
 
-        try:
-            result = mark_attendance_from_video(path_var.get(), session['current_section'])
-            success, marked_students = result
-            if success:
-                show_marked_students(marked_students)
+        def work(video_path, section):
+            try:
+                for event in iter_attendance_events(video_path, section, cancel_event=cancel):
+                    events.put(event)
+            except Exception as e:
+                traceback.print_exc()
+                events.put({'type': 'error', 'message': str(e)})
+
+        def progress_text(fraction, event):
+            text = f"{event['fps']:.1f} frames/s"
+            elapsed = time.perf_counter() - started
+            if fraction > 0.02:
+                remaining = elapsed / fraction * (1 - fraction)
+                text = f"{int(remaining // 60)}:{int(remaining % 60):02d} remaining · " + text
+            return text
+
+        def finish(event):
+            running['cancel'] = None
+            loading.destroy()
+            if event['type'] == 'error':
+                messagebox.showerror("Error", event['message'])
+            elif event['success']:
+                show_marked_students(event['marked_students'])
+            elif cancel.is_set():
+                show_marked_students(found)
+                messagebox.showinfo("Cancelled", "Processing was cancelled; no attendance was saved.")
             else:
                 show_marked_students([])
                 messagebox.showwarning("No Attendance", "No students were recognized or registered for this section.")
-        except Exception as e:
-            messagebox.showerror("Error", str(e))
-        finally:
-            loading.hide()
+
+        def poll():
+            if not loading.winfo_exists():
+                # Navigation cleared the page; stop the worker rather than post to dead widgets
+                cancel.set()
+                running['cancel'] = None
+                return
+            new_marks = False
+            while True:
+                try:
+                    event = events.get_nowait()
+                except queue.Empty:
+                    break
+                if event['type'] == 'progress':
+                    if event.get('segments_total'):
+                        fraction = event['segments_done'] / event['segments_total']
+                    elif event['frames_total']:
+                        fraction = (event['frame'] + 1) / event['frames_total']
+                    else:
+                        continue
+                    if not cancel.is_set():
+                        loading.update_progress(fraction, progress_text(fraction, event))
+                elif event['type'] == 'marked':
+                    found.append((event['name'], event['roll_no']))
+                    new_marks = True
+                elif event['type'] in ('finished', 'error'):
+                    finish(event)
+                    return
+            if new_marks:
+                show_marked_students(found)
+                loading.lift()
+            frame.after(100, poll)
+
+        threading.Thread(target=work, args=(path_var.get(), session['current_section']),
+                         name="facemark-attendance", daemon=True).start()
+        frame.after(100, poll)
 
     # File selection
     file_frame = ctk.CTkFrame(upload_frame, fg_color="transparent")
@@ -749,6 +921,7 @@ def show_attendance_upload(frame):
 
 def show_attendance_history(frame):
     try:
+        import pandas as pd
         ensure_attendance_logs_dir()
         
         container = ctk.CTkFrame(frame, fg_color="transparent")
@@ -898,8 +1071,8 @@ def show_attendance_history(frame):
                             # Create a table-like display
                             table_frame = ctk.CTkFrame(card, fg_color="transparent")
                             table_frame.pack(fill="x", padx=10, pady=5)
-                            # Headers
-                            headers = ["Name", "Roll No", "Section", "Time"]
+                            # Headers follow the CSV, which may carry extra columns such as Cross Section
+                            headers = list(df.columns)
                             for i, header in enumerate(headers):
                                 ctk.CTkLabel(
                                     table_frame,
@@ -928,6 +1101,8 @@ def show_attendance_history(frame):
         show_error("Attendance History Error", str(e))
 
 def show_registered_students_page(frame):
+    from facemark_core import get_registered_students, delete_registered_student
+
     container = ctk.CTkFrame(frame, fg_color=VIBRANT_LIGHT)
     container.pack(fill="both", expand=True, padx=40, pady=40)
 
@@ -972,7 +1147,6 @@ def show_registered_students_page(frame):
 
 if __name__ == "__main__":
     try:
-        ensure_dirs()
         show_login()
     except Exception as e:
         show_error("Application Error", str(e))
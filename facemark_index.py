@@ -0,0 +1,172 @@
+# facemark_index.py
+
+import numpy as np
+
+IVF_NPROBE = 8
+IVF_MIN_SIZE = 256  # below this many vectors an exact scan is as fast as probing lists
+IVF_REBUILD_GROWTH = 0.5  # rebuild the coarse centroids after this much churn since the last build
+
+def top_k(scores, k):
+    """Return (indices, scores) of the `k` best columns of each row, best first.
+
+    Rows with fewer than `k` columns are padded with index -1 and score 0.
+    """
+    scores = np.atleast_2d(scores)
+    rows, cols = scores.shape
+    idx = np.full((rows, k), -1, dtype=np.intp)
+    vals = np.zeros((rows, k), dtype=np.float32)
+    if cols == 0:
+        return idx, vals
+    kk = min(k, cols)
+    if kk < cols:
+        part = np.argpartition(-scores, kk - 1, axis=1)[:, :kk]
+    else:
+        part = np.broadcast_to(np.arange(cols), (rows, cols))
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1)
+    idx[:, :kk] = np.take_along_axis(part, order, axis=1)
+    vals[:, :kk] = np.take_along_axis(part_scores, order, axis=1)
+    return idx, vals
+
+def spherical_kmeans(vectors, k, iterations=15, seed=0):
+    """Cluster L2-normalized `vectors` by cosine similarity; return unit-length centroids."""
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    k = max(1, min(k, len(vectors)))
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        # Restart empty clusters from random members so every list is used
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids.astype(np.float32)
+
+class IVFIndex:
+    """Inverted-file index over L2-normalized embeddings, keyed by student name.
+
+    The vectors are split into `nlist` clusters; a query is only scored
+    against the members of its `nprobe` closest clusters. The index follows
+    gallery changes with `sync`, which adds, moves and drops individual
+    entries and only re-clusters after substantial churn. An index that is
+    being searched must not be synced; sync a `copy()` instead.
+    """
+
+    def __init__(self, nlist=None, nprobe=IVF_NPROBE):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.centroids = None
+        self.lists = []  # per cluster: [names, matrix]
+        self.where = {}  # name -> cluster
+        self.vectors = {}  # name -> vector, to detect changed entries
+        self.built_size = 0
+        self.churn = 0
+
+    def __len__(self):
+        return len(self.where)
+
+    def copy(self):
+        """Return an index that can be synced without changing this one.
+
+        Lists are only ever replaced, never modified in place, so the copy
+        shares their arrays until it changes them.
+        """
+        other = IVFIndex(self.nlist, self.nprobe)
+        other.centroids = self.centroids
+        other.lists = list(self.lists)
+        other.where = dict(self.where)
+        other.vectors = dict(self.vectors)
+        other.built_size = self.built_size
+        other.churn = self.churn
+        return other
+
+    def build(self, names, matrix):
+        """Cluster `matrix` (one row per name) from scratch."""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        nlist = self.nlist or max(1, int(np.sqrt(len(names))))
+        self.centroids = spherical_kmeans(matrix, nlist) if len(names) else np.zeros((0, matrix.shape[1]), np.float32)
+        self.lists = [[[], np.zeros((0, matrix.shape[1]), np.float32)] for _ in range(len(self.centroids))]
+        self.where, self.vectors = {}, {}
+        self.built_size = len(names)
+        self.churn = 0
+        if len(names):
+            self._insert(list(names), matrix)
+
+    def sync(self, names, matrix):
+        """Bring the index in line with the current gallery rows, incrementally when possible."""
+        matrix = np.asarray(matrix, dtype=np.float32)
+        current = {name: i for i, name in enumerate(names)}
+        removed = [name for name in self.where if name not in current]
+        changed = [name for name in current if name not in self.where]
+        known = [name for name in current if name in self.where]
+        if known:
+            # Rewriting the gallery re-normalizes rows, so allow for rounding noise
+            drift = np.abs(np.stack([self.vectors[name] for name in known]) - matrix[[current[name] for name in known]])
+            changed += [name for name, moved in zip(known, drift.max(axis=1) > 1e-5) if moved]
+        self.churn += len(removed) + len(changed)
+        if self.centroids is None or not len(self.centroids) or self.churn > IVF_REBUILD_GROWTH * max(self.built_size, 1):
+            self.build(names, matrix)
+            return
+        self.remove(removed + [name for name in changed if name in self.where])
+        if changed:
+            self._insert(changed, matrix[[current[name] for name in changed]])
+
+    def remove(self, names):
+        """Drop `names` from the index."""
+        by_list = {}
+        for name in names:
+            if name in self.where:
+                by_list.setdefault(self.where.pop(name), set()).add(name)
+                del self.vectors[name]
+        for li, drop in by_list.items():
+            list_names, list_matrix = self.lists[li]
+            keep = [i for i, name in enumerate(list_names) if name not in drop]
+            self.lists[li] = [[list_names[i] for i in keep], list_matrix[keep]]
+
+    def _insert(self, names, matrix):
+        assign = np.argmax(matrix @ self.centroids.T, axis=1)
+        for li in np.unique(assign):
+            rows = np.flatnonzero(assign == li)
+            list_names, list_matrix = self.lists[li]
+            self.lists[li] = [list_names + [names[i] for i in rows], np.vstack([list_matrix, matrix[rows]])]
+        for name, li, row in zip(names, assign, matrix):
+            self.where[name] = int(li)
+            self.vectors[name] = row.copy()
+
+    def search(self, queries, k=2):
+        """Return (names, scores) of the `k` approximate nearest entries for each query."""
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        names = np.full((len(queries), k), None, dtype=object)
+        scores = np.zeros((len(queries), k), dtype=np.float32)
+        if not self.where:
+            return names, scores
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes, _ = top_k(queries @ self.centroids.T, nprobe)
+        for qi, query in enumerate(queries):
+            cand_names = []
+            cand_blocks = []
+            for li in probes[qi]:
+                list_names, list_matrix = self.lists[li]
+                cand_names.extend(list_names)
+                cand_blocks.append(list_matrix)
+            if not cand_names:
+                continue
+            idx, vals = top_k(query[None] @ np.vstack(cand_blocks).T, k)
+            for j in range(k):
+                if idx[0, j] >= 0:
+                    names[qi, j] = cand_names[idx[0, j]]
+                    scores[qi, j] = vals[0, j]
+        return names, scores
+
+def measure_recall(index, names, matrix, queries):
+    """Return the fraction of `queries` whose top-1 from `index` equals the exact top-1."""
+    queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+    if not len(queries) or not len(names):
+        return 1.0
+    exact = np.argmax(queries @ np.asarray(matrix, dtype=np.float32).T, axis=1)
+    approx, _ = index.search(queries, 1)
+    return float(np.mean([approx[i, 0] == names[exact[i]] for i in range(len(queries))]))
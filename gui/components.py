@@ -4,7 +4,7 @@ import customtkinter as ctk
 from .styles import *
 
 class LoadingOverlay(ctk.CTkFrame):
-    def __init__(self, parent, **kwargs):
+    def __init__(self, parent, on_cancel=None, **kwargs):
         super().__init__(parent, **kwargs)
         self.configure(fg_color=VIBRANT_BG, corner_radius=10)
         
@@ -23,6 +23,20 @@ class LoadingOverlay(ctk.CTkFrame):
         self.progress = ctk.CTkProgressBar(self)
         self.progress.pack(pady=10)
         self.progress.set(0)
+
+        self.detail = ctk.CTkLabel(
+            self,
+            text="",
+            font=FONT_SMALL,
+            text_color=VIBRANT_DARK
+        )
+        self.detail.pack(padx=20, pady=(0, 10))
+
+        # Optional cancel button for long-running work
+        self.cancel_button = None
+        if on_cancel is not None:
+            self.cancel_button = ctk.CTkButton(self, text="Cancel", command=on_cancel, width=100)
+            self.cancel_button.pack(pady=(0, 20))
         
         # Hide initially
         self.place_forget()
@@ -34,6 +48,12 @@ class LoadingOverlay(ctk.CTkFrame):
     def hide(self):
         self.place_forget()
 
+    def update_progress(self, fraction, text=None):
+        """Set the bar to `fraction` (0-1) and optionally the detail line below it."""
+        self.progress.set(max(0.0, min(1.0, fraction)))
+        if text is not None:
+            self.detail.configure(text=text)
+
 class ModernButton(ctk.CTkButton):
     def __init__(self, master, **kwargs):
         # Remove fg_color from kwargs if it exists to avoid duplicate
@@ -0,0 +1,195 @@
+import multiprocessing
+import os
+import pickle
+import threading
+
+import numpy as np
+import pytest
+
+import facemark_gallery as fg
+
+DIM = fg.EMBEDDING_DIM
+
+def sample_data(count=6, seed=0):
+    rng = np.random.default_rng(seed)
+    data = {}
+    for i in range(count):
+        rows = rng.standard_normal((1 + i % 3, DIM)).astype(np.float32)
+        data[f"Student{i}"] = {'embedding': rows if len(rows) > 1 else rows[0],
+                               'roll_no': str(100 + i), 'section': "AB"[i % 2]}
+    return data
+
+def assert_same_students(gallery, data):
+    loaded = gallery.to_dict()
+    assert sorted(loaded) == sorted(data)
+    for name, record in data.items():
+        assert loaded[name]['roll_no'] == record['roll_no']
+        assert loaded[name]['section'] == record['section']
+        expected = fg.l2_normalize(np.atleast_2d(record['embedding']))
+        np.testing.assert_allclose(np.atleast_2d(loaded[name]['embedding']), expected, atol=1e-6)
+
+def prototypes(seed, rows=2):
+    return np.random.default_rng(seed).standard_normal((rows, DIM)).astype(np.float32)
+
+@pytest.fixture
+def gallery_dir(tmp_path):
+    path = str(tmp_path / "gallery")
+    yield path
+    fg.invalidate_gallery_cache(path)
+
+def test_round_trip(gallery_dir):
+    data = sample_data()
+    fg.write_gallery(fg.build_gallery(data), gallery_dir)
+
+    gallery = fg.read_gallery(gallery_dir)
+    assert isinstance(gallery.matrix, np.memmap)
+    assert_same_students(gallery, data)
+    assert [name for name, _, _ in gallery.list_students("A")] == ["Student0", "Student2", "Student4"]
+    start, end = gallery.row_range("B")
+    assert end - start == sum(len(np.atleast_2d(data[f"Student{i}"]['embedding'])) for i in (1, 3, 5))
+
+def test_round_trip_quantized(gallery_dir):
+    data = sample_data()
+    fg.write_gallery(fg.build_gallery(data), gallery_dir, quantization='int8')
+
+    gallery = fg.read_gallery(gallery_dir)
+    assert gallery.quantization == 'int8'
+    restored = gallery.quantized.astype(np.float32) * gallery.scales[:, None]
+    np.testing.assert_allclose(restored, gallery.matrix, atol=0.01)
+
+def test_migrates_legacy_pickle(tmp_path, gallery_dir):
+    data = sample_data()
+    pickle_path = str(tmp_path / "embeddings.pkl")
+    with open(pickle_path, 'wb') as f:
+        pickle.dump(data, f)
+
+    assert not fg.gallery_exists(gallery_dir)
+    gallery = fg.get_gallery(gallery_dir, pickle_path)
+    assert fg.gallery_exists(gallery_dir)
+    assert fg.current_version(gallery_dir) == 1
+    assert os.path.exists(pickle_path)
+    assert_same_students(gallery, data)
+    assert_same_students(fg.read_gallery(gallery_dir), data)
+
+def test_journal_replay(gallery_dir):
+    data = sample_data()
+    fg.write_gallery(fg.build_gallery(data), gallery_dir)
+    pin = fg.read_gallery(gallery_dir).pin
+
+    fg.append_journal({"New": {'prototypes': prototypes(1), 'roll_no': "200", 'section': "A"}}, gallery_dir)
+    fg.append_journal({"Student1": None}, gallery_dir)
+    # A None roll_no or section keeps the value from the snapshot
+    fg.append_journal({"Student2": {'prototypes': prototypes(2, 1), 'roll_no': None, 'section': None}}, gallery_dir)
+
+    gallery = fg.read_gallery(gallery_dir)
+    assert "Student1" not in gallery
+    assert gallery.info("New") == {'roll_no': "200", 'section': "A"}
+    assert gallery.info("Student2") == {'roll_no': "102", 'section': "A"}
+    np.testing.assert_allclose(gallery.prototypes("Student2"), fg.l2_normalize(prototypes(2, 1)), atol=1e-6)
+    names = [s['name'] for s in gallery.students]
+    assert names == sorted(names, key=lambda name: (gallery.info(name)['section'], name))
+
+    # A pin reproduces the state it was taken from
+    assert_same_students(fg.read_gallery(gallery_dir, pin=pin), data)
+
+    # Compaction folds the journal into a new snapshot with the same contents
+    before = gallery.to_dict()
+    fg.rewrite_gallery(gallery_dir, legacy_pickle=None)
+    assert fg.journal_size(gallery_dir) == 0
+    assert fg.current_version(gallery_dir) == pin[0] + 1
+    assert_same_students(fg.read_gallery(gallery_dir), before)
+
+def test_journal_ignores_and_truncates_torn_record(gallery_dir):
+    fg.write_gallery(fg.build_gallery(sample_data()), gallery_dir)
+    fg.append_journal({"New": {'prototypes': prototypes(1), 'roll_no': "200", 'section': "A"}}, gallery_dir)
+    journal = os.path.join(fg.snapshot_dir(gallery_dir, fg.current_version(gallery_dir)), fg.JOURNAL_FILE)
+    complete = os.path.getsize(journal)
+
+    # An interrupted append leaves a header promising more bytes than were written
+    with open(journal, 'ab') as f:
+        f.write(fg._RECORD_HEADER.pack(1000) + b"partial")
+    assert "New" in fg.read_gallery(gallery_dir)
+    assert fg.journal_records(gallery_dir) == 1
+
+    fg.append_journal({"Later": {'prototypes': prototypes(3), 'roll_no': "201", 'section': "B"}}, gallery_dir)
+    gallery = fg.read_gallery(gallery_dir)
+    assert "New" in gallery and "Later" in gallery
+    assert fg.journal_records(gallery_dir) == 2
+    with open(journal, 'rb') as f:
+        f.seek(complete)
+        assert b"partial" not in f.read()
+
+def append_students(gallery_dir, worker, count):
+    for i in range(count):
+        name = f"W{worker}-{i}"
+        fg.append_journal({name: {'prototypes': prototypes(worker * 1000 + i, 1), 'roll_no': name,
+                                  'section': "AB"[worker % 2]}}, gallery_dir)
+        if i % 5 == 4:
+            fg.compact_gallery(gallery_dir, legacy_pickle=None)
+
+def test_concurrent_appends_from_processes(gallery_dir):
+    fg.write_gallery(fg.build_gallery(sample_data(2)), gallery_dir)
+    workers, count = 4, 15
+    processes = [multiprocessing.Process(target=append_students, args=(gallery_dir, worker, count))
+                 for worker in range(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+    gallery = fg.read_gallery(gallery_dir)
+    assert len(gallery) == 2 + workers * count
+    for worker in range(workers):
+        for i in range(count):
+            assert gallery.info(f"W{worker}-{i}")['roll_no'] == f"W{worker}-{i}"
+
+def test_snapshots_are_pruned(gallery_dir):
+    data = sample_data()
+    for _ in range(fg.SNAPSHOT_KEEP + 2):
+        fg.write_gallery(fg.build_gallery(data), gallery_dir)
+
+    latest = fg.current_version(gallery_dir)
+    assert latest == fg.SNAPSHOT_KEEP + 2
+    assert fg._snapshot_versions(gallery_dir) == list(range(latest - fg.SNAPSHOT_KEEP + 1, latest + 1))
+    assert not [entry for entry in os.listdir(os.path.join(gallery_dir, fg.SNAPSHOTS_DIR)) if entry.endswith(".tmp")]
+    with pytest.raises(FileNotFoundError):
+        fg.read_gallery(gallery_dir, pin=(1, 0))
+
+def test_projection_is_pinned_with_its_snapshot(gallery_dir):
+    fg.write_gallery(fg.build_gallery(sample_data()), gallery_dir)
+    pin = fg.read_gallery(gallery_dir).pin
+    gallery = fg.read_gallery(gallery_dir)
+    fg.write_projection(fg.fit_pca(gallery.matrix, 4), gallery_dir)
+
+    assert fg.read_gallery(gallery_dir).projection[1].shape == (4, DIM)
+    assert fg.read_gallery(gallery_dir, pin=pin).projection is None
+    fg.write_gallery(fg.build_gallery(sample_data()), gallery_dir)
+    assert fg.read_gallery(gallery_dir).projection is not None
+
+def test_loading_compacts_an_old_journal(gallery_dir):
+    fg.write_gallery(fg.build_gallery(sample_data()), gallery_dir)
+    fg.append_journal({"New": {'prototypes': prototypes(1), 'roll_no': "200", 'section': "A"}}, gallery_dir)
+    version = fg.current_version(gallery_dir)
+    meta = os.path.join(fg.snapshot_dir(gallery_dir, version), fg.META_FILE)
+    old = os.path.getmtime(meta) - fg.JOURNAL_COMPACT_AGE - 1
+    os.utime(meta, (old, old))
+
+    assert "New" in fg.get_gallery(gallery_dir, legacy_pickle=None)
+    for thread in threading.enumerate():
+        if thread.name == "gallery-compaction":
+            thread.join(30)
+    assert fg.current_version(gallery_dir) == version + 1
+    assert fg.journal_size(gallery_dir) == 0
+    assert "New" in fg.get_gallery(gallery_dir, legacy_pickle=None)
+
+def test_compaction_refits_projection(gallery_dir):
+    fg.write_gallery(fg.build_gallery(sample_data()), gallery_dir)
+    fg.write_projection(fg.fit_pca(fg.read_gallery(gallery_dir).matrix, 4), gallery_dir)
+    fg.append_journal({"New": {'prototypes': prototypes(1, 3), 'roll_no': "200", 'section': "A"}}, gallery_dir)
+
+    fg.compact_gallery(gallery_dir, legacy_pickle=None)
+    gallery = fg.read_gallery(gallery_dir)
+    expected = fg.fit_pca(gallery.matrix, 4)
+    assert gallery.projection[1].shape == (4, DIM)
+    np.testing.assert_allclose(gallery.projection[0], expected[0], atol=1e-6)
@@ -0,0 +1,85 @@
+import numpy as np
+
+import facemark_core as fc
+from facemark_index import IVFIndex, measure_recall
+
+DIM = fc.EMBEDDING_DIM
+
+def vectors(count, seed=0):
+    rng = np.random.default_rng(seed)
+    return fc.l2_normalize(rng.standard_normal((count, DIM)).astype(np.float32))
+
+def perturbed(matrix, noise=0.3, seed=1):
+    rng = np.random.default_rng(seed)
+    return fc.l2_normalize(matrix + rng.normal(scale=noise / np.sqrt(DIM), size=matrix.shape))
+
+def test_search_finds_exact_neighbours():
+    matrix = vectors(400)
+    names = [f"S{i}" for i in range(len(matrix))]
+    index = IVFIndex(nlist=8, nprobe=8)
+    index.build(names, matrix)
+    assert len(index) == len(names)
+
+    # Probing every list is an exhaustive search
+    found, scores = index.search(perturbed(matrix[:50]), 2)
+    assert list(found[:, 0]) == names[:50]
+    exact = np.sort(perturbed(matrix[:50]) @ matrix.T, axis=1)[:, ::-1][:, :2]
+    np.testing.assert_allclose(scores, exact, atol=1e-5)
+    assert measure_recall(index, names, matrix, perturbed(matrix)) == 1.0
+
+def test_sync_follows_gallery_changes():
+    matrix = vectors(300)
+    names = [f"S{i}" for i in range(len(matrix))]
+    index = IVFIndex(nlist=4, nprobe=4)
+    index.sync(names, matrix)
+    centroids = index.centroids
+
+    # Drop one student, move another and add a new one
+    moved = vectors(1, seed=5)
+    new = vectors(1, seed=6)
+    names2 = names[1:] + ["New"]
+    matrix2 = np.vstack([matrix[1:], new])
+    matrix2[0] = moved[0]
+    index.sync(names2, matrix2)
+
+    assert index.centroids is centroids  # small churn is applied incrementally
+    assert len(index) == len(names2)
+    assert "S0" not in index.where
+    found, _ = index.search(np.vstack([moved, new]), 1)
+    assert list(found[:, 0]) == ["S1", "New"]
+    assert sum(len(list_names) for list_names, _ in index.lists) == len(names2)
+
+def test_sync_rebuilds_after_large_churn():
+    matrix = vectors(100)
+    index = IVFIndex(nlist=4, nprobe=4)
+    index.sync([f"S{i}" for i in range(100)], matrix)
+    centroids = index.centroids
+    index.sync([f"T{i}" for i in range(100)], vectors(100, seed=3))
+    assert index.centroids is not centroids
+    assert index.churn == 0 and set(index.where) == {f"T{i}" for i in range(100)}
+
+def test_copy_is_independent():
+    matrix = vectors(50)
+    names = [f"S{i}" for i in range(50)]
+    index = IVFIndex(nlist=4, nprobe=4)
+    index.build(names, matrix)
+    copy = index.copy()
+    copy.sync(names[:-1] + ["New"], np.vstack([matrix[:-1], vectors(1, seed=9)]))
+
+    assert "S49" in index.where and "New" not in index.where
+    assert sum(len(list_names) for list_names, _ in index.lists) == 50
+    found, _ = index.search(matrix[-1:], 1)
+    assert found[0, 0] == "S49"
+
+def test_matcher_with_index_agrees_with_exact_scan():
+    rng = np.random.default_rng(2)
+    data = {f"S{i}": {'embedding': rng.standard_normal((1 + i % 2, DIM)).astype(np.float32)} for i in range(80)}
+    exact = fc.GalleryMatcher(data)
+    approx = fc.GalleryMatcher(data)
+    approx.index = IVFIndex(nlist=4, nprobe=4)
+    approx.index.sync(approx.keys, approx.matrix)
+
+    queries = perturbed(exact.matrix)
+    for a, b in zip(exact.match(queries), approx.match(queries)):
+        assert (a.name, a.runner_up) == (b.name, b.runner_up)
+        assert abs(a.score - b.score) < 1e-5 and abs(a.runner_up_score - b.runner_up_score) < 1e-5
@@ -0,0 +1,109 @@
+import numpy as np
+
+import facemark_core as fc
+from facemark_index import top_k
+
+DIM = fc.EMBEDDING_DIM
+
+def sample_data(count=12, seed=0):
+    rng = np.random.default_rng(seed)
+    return {f"Student{i}": {'embedding': rng.standard_normal((1 + i % 3, DIM)).astype(np.float32),
+                            'roll_no': str(100 + i), 'section': "AB"[i % 2]}
+            for i in range(count)}
+
+def queries_near(data, noise=0.5, seed=1):
+    """One perturbed copy of every prototype, plus a few faces that match no one."""
+    rng = np.random.default_rng(seed)
+    rows = np.concatenate([np.atleast_2d(record['embedding']) for record in data.values()])
+    rows = fc.l2_normalize(rows)
+    near = rows + rng.normal(scale=noise / np.sqrt(DIM), size=rows.shape)
+    return np.vstack([near, rng.standard_normal((4, DIM))]).astype(np.float32)
+
+def brute_force(data, queries):
+    """(best, score, runner_up, runner_up_score) per query from a plain loop over every prototype."""
+    names = list(data)
+    results = []
+    for query in fc.l2_normalize(queries):
+        scores = [max(float(row @ query) for row in fc.l2_normalize(np.atleast_2d(data[name]['embedding'])))
+                  for name in names]
+        order = np.argsort(scores)[::-1]
+        runner_up = (names[order[1]], scores[order[1]]) if len(names) > 1 else (None, 0.0)
+        results.append((names[order[0]], scores[order[0]]) + runner_up)
+    return results
+
+def assert_matches(matches, expected):
+    assert len(matches) == len(expected)
+    for match, (name, score, runner_up, runner_up_score) in zip(matches, expected):
+        assert match.name == name
+        assert match.runner_up == runner_up
+        assert abs(match.score - score) < 1e-5
+        assert abs(match.runner_up_score - runner_up_score) < 1e-5
+
+def test_top_k_orders_and_pads():
+    scores = np.array([[0.1, 0.9, 0.5], [0.3, 0.2, 0.7]], dtype=np.float32)
+    idx, vals = top_k(scores, 2)
+    assert idx.tolist() == [[1, 2], [2, 0]]
+    np.testing.assert_allclose(vals, [[0.9, 0.5], [0.7, 0.3]])
+
+    idx, vals = top_k(scores, 5)
+    assert idx[:, 3:].tolist() == [[-1, -1], [-1, -1]]
+    assert not vals[:, 3:].any()
+
+    idx, vals = top_k(np.zeros((2, 0), dtype=np.float32), 2)
+    assert (idx == -1).all() and not vals.any()
+
+def test_match_agrees_with_brute_force():
+    data = sample_data()
+    matcher = fc.GalleryMatcher(data)
+    queries = queries_near(data)
+    assert_matches(matcher.match(queries), brute_force(data, queries))
+
+def test_match_without_runner_up():
+    data = sample_data(1)
+    matches = fc.GalleryMatcher(data).match(queries_near(data))
+    assert all(m.runner_up is None and m.runner_up_score == 0.0 for m in matches)
+    assert fc.GalleryMatcher({}).match(queries_near(data)[:2]) == [fc.Match(None, 0.0, None, 0.0)] * 2
+
+def test_quantized_rerank_returns_exact_scores():
+    data = sample_data(40)
+    gallery = fc.build_gallery(data)
+    matcher = fc.GalleryMatcher.from_gallery(gallery)
+    matcher.quantized, matcher.scales = fc.quantize(matcher.matrix, 'int8')
+    queries = queries_near(data)
+    # Students come back in the gallery's section order, so compare against the same order
+    ordered = {name: data[name] for name in matcher.names}
+    assert_matches(matcher.match(queries), brute_force(ordered, queries))
+
+def test_quantized_rerank_in_small_section():
+    # Fewer students than RERANK_CANDIDATES leaves padded candidates in the shortlist
+    data = sample_data(fc.RERANK_CANDIDATES - 2)
+    gallery = fc.build_gallery(data)
+    matcher = fc.GalleryMatcher.from_gallery(gallery)
+    matcher.quantized, matcher.scales = fc.quantize(matcher.matrix, 'int8')
+    queries = queries_near(data)
+    matches = matcher.match(queries)
+    assert all(np.isfinite(m.runner_up_score) for m in matches)
+    assert_matches(matches, brute_force({name: data[name] for name in matcher.names}, queries))
+
+    single = fc.GalleryMatcher.from_gallery(fc.build_gallery(sample_data(1)))
+    single.quantized, single.scales = fc.quantize(single.matrix, 'int8')
+    match = single.match(queries[:1])[0]
+    assert match.runner_up is None and match.runner_up_score == 0.0
+
+def test_hierarchical_matcher_falls_back_to_other_sections():
+    data = sample_data()
+    gallery = fc.build_gallery(data)
+    section = fc.GalleryMatcher.from_gallery(gallery, "A")
+    matcher = fc.HierarchicalMatcher(section, fc.GalleryMatcher.from_gallery(gallery))
+    home = fc.l2_normalize(np.atleast_2d(data["Student0"]['embedding']))[:1]
+    visitor = fc.l2_normalize(np.atleast_2d(data["Student1"]['embedding']))[:1]
+
+    match = matcher.match(home)[0]
+    assert match.name == "Student0"
+    assert matcher.fallback_lookups == 0
+
+    match = matcher.match(visitor)[0]
+    assert match.name == "Student1" and match.score > fc.MATCH_THRESHOLD
+    assert matcher.fallback_lookups == 1
+    assert matcher.info["Student1"]['section'] == "B"
+    assert len(matcher) == len(section.names) == 6
@@ -0,0 +1,154 @@
+import numpy as np
+import pytest
+
+import facemark_core as fc
+
+Match = fc.Match
+
+def test_box_iou():
+    iou = fc.box_iou([(0, 0, 10, 10), (100, 100, 10, 10)], [(0, 0, 10, 10), (5, 0, 10, 10), (50, 50, 5, 5)])
+    assert iou.shape == (2, 3)
+    np.testing.assert_allclose(iou[0], [1.0, 50 / 150, 0.0])
+    np.testing.assert_allclose(iou[1], [0.0, 0.0, 0.0])
+    assert fc.box_iou([], [(0, 0, 1, 1)]).shape == (0, 1)
+
+def test_tracker_links_boxes_across_frames():
+    tracker = fc.FaceTracker(max_missed=1)
+    first = tracker.update([(0, 0, 50, 50), (200, 0, 50, 50)])
+    second = tracker.update([(205, 2, 50, 50), (3, 1, 50, 50)])
+    assert [t.id for t in second] == [first[1].id, first[0].id]
+
+    # A track survives max_missed frames without a box, then a new one starts
+    tracker.update([])
+    assert tracker.update([(3, 1, 50, 50)])[0].id == first[0].id
+    tracker.update([])
+    tracker.update([])
+    assert tracker.update([(3, 1, 50, 50)])[0].id not in (first[0].id, first[1].id)
+
+def test_tracker_resolves_confident_match_and_stops_embedding():
+    tracker = fc.FaceTracker()
+    track = tracker.update([(0, 0, 50, 50)])[0]
+    assert tracker.needs_embedding(track)
+    assert tracker.record(track.id, Match("A", 0.9, None, 0.0)) is track
+    assert track.identity == "A" and track.score == 0.9
+    track = tracker.update([(1, 0, 50, 50)])[0]
+    assert not tracker.needs_embedding(track)
+    assert tracker.reused == 1
+
+def test_tracker_votes_on_uncertain_matches():
+    tracker = fc.FaceTracker(max_embeds=3)
+    track = tracker.update([(0, 0, 50, 50)])[0]
+    votes = [Match("A", 0.6, "B", 0.5), Match("B", 0.65, "A", 0.6), Match("A", 0.55, "B", 0.5)]
+    for i, match in enumerate(votes):
+        tracker.update([(i, 0, 50, 50)])
+        assert tracker.needs_embedding(track)
+        resolved = tracker.record(track.id, match)
+    assert resolved is track
+    assert track.identity == "A" and track.score == 0.6
+
+def test_tracker_awaiting_votes_and_finalize():
+    tracker = fc.FaceTracker(max_embeds=2)
+    track = tracker.update([(0, 0, 50, 50)])[0]
+    assert tracker.needs_embedding(track) and tracker.needs_embedding(track)
+    # Both crops are still queued for FaceNet
+    assert tracker.awaiting_votes(track.id)
+    tracker.record(track.id, Match("A", 0.6, None, 0.0))
+    assert tracker.finalize() == [track]
+    assert track.identity == "A"
+
+def test_tracker_retries_unidentified_track():
+    tracker = fc.FaceTracker(max_embeds=2, retry_frames=4)
+    box = (0, 0, 50, 50)
+    track = tracker.update([box])[0]
+    for _ in range(2):
+        assert tracker.needs_embedding(track)
+        tracker.record(track.id, Match("A", 0.3, None, 0.0))
+        tracker.update([box])
+    assert track.resolved and track.identity is None
+
+    skipped = 0
+    while not tracker.needs_embedding(track):
+        skipped += 1
+        tracker.update([box])
+    assert skipped == 3
+    assert not track.resolved and track.votes == []
+    assert tracker.record(track.id, Match("A", 0.8, None, 0.0)) is track
+    assert track.identity == "A"
+
+class StubEmbedder:
+    def __init__(self):
+        self.calls = []
+
+    def embeddings(self, faces):
+        self.calls.append(len(faces))
+        # Encode each crop's fill value so results can be traced back to it
+        return np.repeat(faces.reshape(len(faces), -1)[:, :1].astype(np.float32), fc.EMBEDDING_DIM, axis=1)
+
+@pytest.fixture
+def embedder(monkeypatch):
+    stub = StubEmbedder()
+    monkeypatch.setattr(fc, 'get_embedder', lambda: stub)
+    return stub
+
+def crop(value):
+    return np.full(fc.FACE_SIZE + (3,), value, dtype=np.uint8)
+
+def test_embedding_batcher_embeds_full_batches(embedder):
+    batcher = fc.EmbeddingBatcher(batch_size=3, max_wait=None)
+    results = [batcher.add(crop(i), tag=i) for i in range(7)]
+    assert [tags for tags, _ in results] == [[], [], [0, 1, 2], [], [], [3, 4, 5], []]
+    np.testing.assert_array_equal(results[2][1][:, 0], [0, 1, 2])
+    assert batcher.poll() == ([], None)
+    tags, embeddings = batcher.flush()
+    assert tags == [6] and embeddings.shape == (1, fc.EMBEDDING_DIM)
+    assert batcher.flush() == ([], None)
+    assert embedder.calls == [3, 3, 1]
+    assert (batcher.calls, batcher.embedded) == (3, 7)
+
+def test_embedding_batcher_flushes_after_max_wait(embedder, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(fc.time, 'monotonic', lambda: now[0])
+    batcher = fc.EmbeddingBatcher(batch_size=10, max_wait=2.0)
+    assert batcher.add(crop(1), tag="a") == ([], None)
+    now[0] += 1.0
+    assert batcher.poll() == ([], None)
+    now[0] += 1.0
+    tags, _ = batcher.poll()
+    assert tags == ["a"] and len(batcher) == 0
+
+def test_plan_segments():
+    assert fc.plan_segments(100, 10, 3) == [(0, 30), (30, 60), (60, 90), (90, None)]
+    assert fc.plan_segments(20, 10, 3) == [(0, None)]
+    assert fc.plan_segments(0, 10, 3) == [(0, None)]
+    # Without a frame rate the whole video is one segment
+    assert fc.plan_segments(100, 0, 3) == [(0, None)]
+
+def segment_result(scores, first_seen, stop_frame, timestamps, **extra):
+    stats = {key: 1 for key in ['frames_analysed', 'faces_detected', 'frames_gated', 'tracks', 'faces_reused',
+                                'faces_embedded', 'embedding_calls', 'fallback_lookups']}
+    stats.update(first_seen={name: t for name, (t, _) in first_seen.items()},
+                 first_seen_frame={name: f for name, (_, f) in first_seen.items()},
+                 timestamps=timestamps, elapsed=1.0, fps=10.0, frame_stride=1, frames_total=60,
+                 stop_reason='end_of_video', stop_frame=stop_frame, stop_timestamp=stop_frame / 10.0)
+    stats.update(extra)
+    return scores, stats
+
+def test_merge_scan_results():
+    first = segment_result({"A": 0.7, "B": 0.6}, {"A": (0.5, 5), "B": (2.0, 20)}, 29, [0.5, 2.0])
+    second = segment_result({"B": 0.9, "C": 0.8}, {"B": (3.5, 35), "C": (4.0, 40)}, 59, [3.5, 4.0], elapsed=2.0)
+    scores, stats = fc.merge_scan_results([first, second])
+
+    assert scores == {"A": 0.7, "B": 0.9, "C": 0.8}
+    # First sightings come from the earliest segment that saw the student
+    assert stats['first_seen'] == {"A": 0.5, "B": 2.0, "C": 4.0}
+    assert stats['first_seen_frame'] == {"A": 5, "B": 20, "C": 40}
+    assert stats['frames_analysed'] == 2 and stats['faces_embedded'] == 2
+    assert stats['timestamps'] == [0.5, 2.0, 3.5, 4.0]
+    assert stats['elapsed'] == 2.0 and stats['segments'] == 2
+    assert (stats['stop_reason'], stats['stop_frame']) == ('end_of_video', 59)
+
+def test_segments_reject_saturation_window(tmp_path):
+    events = fc.iter_attendance_events(str(tmp_path / "missing.mp4"), saturation_window=10, workers=2,
+                                       segment_seconds=60)
+    with pytest.raises(ValueError):
+        next(events)